@@ -3,6 +3,7 @@
 import os
 import subprocess
 
+from swh.loader.dir.manifest import Manifest
 from swh.model.hashutil import MultiHash, hash_to_bytes
 
 BATCH_SIZE = 10000
@@ -15,6 +16,10 @@ config = {
     # without anything git related
     'dir_path': '/home/tony/work/inria/repo/linux-tryouts',
 
+    # manifest saved by DirLoader.load(save_manifest=...), checked
+    # instead of the folders above, without hashing anything
+    'manifest': None,
+
     'storage_class': 'remote_storage',
     'storage_args': ['http://localhost:5002/'],
 }
@@ -185,5 +190,75 @@ def check_missing_trees(rootpath):
     print()
 
 
-check_missing_contents(config['dir_path'])
-check_missing_trees(config['dir_path_git'])
+def content_missing_by_sha1_git(sha1_gits):
+    """List the contents missing from storage, looked up by sha1_git only,
+    the only hash all the contents of a manifest have.
+
+    """
+    found = storage.object_find_by_sha1_git(sha1_gits)
+    for sha1_git in sha1_gits:
+        if not any(obj['type'] == 'content'
+                   for obj in found.get(sha1_git, [])):
+            yield sha1_git
+
+
+def check_missing_from_manifest(manifest_path):
+    """Check the contents and directories listed in a manifest.
+
+    The skipped contents, which are not archived, are only reported.
+
+    """
+    print('Manifest to check: %s' % manifest_path)
+    with Manifest(manifest_path) as manifest:
+        paths = {}
+        for path, entry in manifest.paths():
+            paths.setdefault(entry['target'], path.decode('utf-8', 'replace'))
+
+        contents = []
+        skipped_contents = []
+        for content in manifest.contents():
+            if content.get('status') == 'absent':
+                skipped_contents.append(content['sha1_git'])
+            else:
+                contents.append(content['sha1_git'])
+
+        for object_type, objects, find_missing in [
+                ('contents', contents, content_missing_by_sha1_git),
+                ('dirs', manifest.directory_ids(),
+                 storage.directory_missing)]:
+            missings = []
+            count_checked = 0
+            batch = []
+            for obj in objects:
+                batch.append(obj)
+                if len(batch) < BATCH_SIZE:
+                    continue
+                missings.extend(find_missing(batch))
+                count_checked += len(batch)
+                batch = []
+            if batch:
+                missings.extend(find_missing(batch))
+                count_checked += len(batch)
+
+            print('Number of %s checked: %s' % (object_type, count_checked))
+            print('Stats on missing %s -' % object_type)
+            if missings:
+                print('Missing %s: ' % object_type)
+                for missing in missings:
+                    print('- %s' % paths.get(missing, '/'))
+            else:
+                print('Nothing missing!')
+            print()
+
+        print('Number of skipped contents (too large, not archived): %s' %
+              len(skipped_contents))
+        for sha1_git in skipped_contents:
+            print('- %s' % paths.get(sha1_git, '/'))
+        print()
+
+
+if config['manifest']:
+    check_missing_from_manifest(config['manifest'])
+else:
+    check_missing_contents(config['dir_path'])
+    check_missing_trees(config['dir_path_git'])
@@ -0,0 +1,141 @@
+# Copyright (C) 2018  The Software Heritage developers
+# See the AUTHORS file at the top-level directory of this distribution
+# License: GNU General Public License version 3, or any later version
+# See top-level LICENSE file for more information
+
+import math
+
+# Packet sizes which can be adapted, per type of object sent
+PACKET_SIZES = {
+    'content': ['content_packet_size', 'content_packet_size_bytes'],
+    'directory': ['directory_packet_size'],
+}
+
+
+class AIMDPacketSize:
+    """An additive-increase/multiplicative-decrease packet size.
+
+    The size grows by `increase` after each request served within the
+    target latency, and is multiplied by `decrease` after each slower
+    request, staying within [`minimum`, `maximum`].
+
+    Args:
+        size (int): initial size
+        minimum (int): lower bound of the size
+        maximum (int): upper bound of the size
+        increase (int): additive increase step, defaults to `minimum`
+        decrease (float): multiplicative decrease factor
+
+    """
+    def __init__(self, size, *, minimum, maximum, increase=None,
+                 decrease=0.5):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.increase = increase or minimum
+        self.decrease = decrease
+        self.size = min(max(size, minimum), maximum)
+
+    def update(self, latency, target_latency):
+        """Adapt the size to the `latency` of the last request.
+
+        Returns:
+            int: the new size
+
+        """
+        if latency > target_latency:
+            self.size = max(self.minimum, int(self.size * self.decrease))
+        else:
+            self.size = min(self.maximum, self.size + self.increase)
+        return self.size
+
+
+class AdaptivePacketSizes:
+    """The packet sizes of a loader, adapted to the latency of the storage.
+
+    Args:
+        config (dict): the `adaptive_packets` loader configuration, with
+          the `target_latency` (in seconds) of a storage request and, for
+          each adapted packet size, a [minimum, maximum] pair of bounds
+        initial (dict): the loader configuration holding the initial
+          packet sizes
+
+    """
+    def __init__(self, config, initial):
+        self.target_latency = config['target_latency']
+        self.sizes = {}
+        for keys in PACKET_SIZES.values():
+            for key in keys:
+                if key not in config:
+                    continue
+                minimum, maximum = config[key]
+                self.sizes[key] = AIMDPacketSize(
+                    initial[key], minimum=minimum, maximum=maximum)
+
+        self.stats = {
+            object_type: {'requests': 0, 'failures': 0, 'objects': 0,
+                          'bytes': 0, 'seconds': 0.0}
+            for object_type in PACKET_SIZES
+        }
+
+    def get(self, key, default):
+        """Get the current value of the packet size `key`.
+
+        """
+        if key in self.sizes:
+            return self.sizes[key].size
+        return default
+
+    def observe(self, object_type, latency, num_objects, num_bytes=0):
+        """Account for a request sending `num_objects` objects of type
+        `object_type` to the storage, which took `latency` seconds.
+
+        """
+        stats = self.stats[object_type]
+        stats['requests'] += 1
+        stats['objects'] += num_objects
+        stats['bytes'] += num_bytes
+        stats['seconds'] += latency
+
+        for key in PACKET_SIZES[object_type]:
+            if key in self.sizes:
+                self.sizes[key].update(latency, self.target_latency)
+
+    def observe_failure(self, object_type):
+        """Account for a request sending objects of type `object_type` to
+        the storage, which failed (e.g. timed out): it counts as a request
+        over the target latency.
+
+        Returns:
+            bool: whether any packet size of `object_type` was reduced
+
+        """
+        self.stats[object_type]['failures'] += 1
+
+        reduced = False
+        for key in PACKET_SIZES[object_type]:
+            if key in self.sizes:
+                size = self.sizes[key].size
+                if self.sizes[key].update(math.inf,
+                                          self.target_latency) < size:
+                    reduced = True
+        return reduced
+
+    def summary(self):
+        """Summarize the throughput observed per type of object.
+
+        Returns:
+            dict: a flat dictionary, suitable for structured logging
+
+        """
+        ret = {}
+        for object_type, stats in self.stats.items():
+            seconds = stats['seconds']
+            ret.update({
+                '%s_requests' % object_type: stats['requests'],
+                '%s_failures' % object_type: stats['failures'],
+                '%s_objects_per_second' % object_type:
+                    stats['objects'] / seconds if seconds else 0,
+                '%s_bytes_per_second' % object_type:
+                    stats['bytes'] / seconds if seconds else 0,
+            })
+        return ret
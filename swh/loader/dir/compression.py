@@ -0,0 +1,122 @@
+# Copyright (C) 2018  The Software Heritage developers
+# See the AUTHORS file at the top-level directory of this distribution
+# License: GNU General Public License version 3, or any later version
+# See top-level LICENSE file for more information
+
+import collections
+import gzip
+
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from swh.core.serializers import encode_data_client as encode_data
+from swh.storage.api.client import RemoteStorage
+
+
+class EncodedPacket(list):
+    """A packet of contents, along with its (future) encoded request body.
+
+    """
+    def __init__(self, contents, encoded):
+        super().__init__(contents)
+        self.encoded = encoded
+
+
+class CompressedRemoteStorage(RemoteStorage):
+    """Proxy to a remote storage API, sending compressed contents.
+
+    The body of `content_add` requests is gzip-compressed when larger than
+    `threshold` bytes. The storage server must decompress request bodies,
+    e.g. by being wrapped in a :class:`GzipRequestMiddleware`.
+
+    Compression runs in a pool of threads, so that packets can be
+    compressed ahead of their upload (see :func:`prefetch`). The pool is
+    started on the first prefetch, and stopped by :func:`close`.
+
+    Args:
+        url (str): url of the remote storage
+        timeout (float): timeout of the requests
+        threshold (int): minimal size of the request bodies to compress
+        level (int): gzip compression level
+        workers (int): number of compression threads
+
+    """
+    def __init__(self, url, timeout=None, *, threshold=65536, level=6,
+                 workers=2):
+        super().__init__(url, timeout=timeout)
+        self.threshold = threshold
+        self.level = level
+        self.workers = workers
+        self.executor = None
+
+    def encode_content_add(self, content):
+        """Encode the body of a `content_add` request.
+
+        Returns:
+            tuple: the (possibly compressed) body, and the request headers
+
+        """
+        data = encode_data({'content': content})
+        headers = {'content-type': 'application/x-msgpack'}
+        if len(data) >= self.threshold:
+            data = gzip.compress(data, compresslevel=self.level)
+            headers['content-encoding'] = 'gzip'
+        return data, headers
+
+    def prefetch(self, packets, ahead=2):
+        """Encode packets of contents in the background, `ahead` packets
+        ahead of the one being consumed.
+
+        Yields:
+            EncodedPacket: the packets, in order
+
+        """
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=self.workers)
+
+        pending = collections.deque()
+        for packet in packets:
+            pending.append(EncodedPacket(
+                packet, self.executor.submit(self.encode_content_add,
+                                             packet)))
+            if len(pending) > ahead:
+                yield pending.popleft()
+
+        while pending:
+            yield pending.popleft()
+
+    def close(self):
+        """Stop the compression threads, once the pending packets are
+        encoded.
+
+        """
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+    def content_add(self, content):
+        if isinstance(content, EncodedPacket):
+            data, headers = content.encoded.result()
+        else:
+            data, headers = self.encode_content_add(content)
+        response = self.raw_post('content/add', data, headers=headers)
+        return self._decode_response(response)
+
+
+class GzipRequestMiddleware:
+    """WSGI middleware decompressing gzip-encoded request bodies, to wrap
+    the storage server receiving contents from a
+    :class:`CompressedRemoteStorage`.
+
+    """
+    def __init__(self, app):
+        self.app = app
+
+    def __call__(self, environ, start_response):
+        if environ.get('HTTP_CONTENT_ENCODING') == 'gzip':
+            length = int(environ.get('CONTENT_LENGTH') or 0)
+            data = gzip.decompress(environ['wsgi.input'].read(length))
+            environ['wsgi.input'] = BytesIO(data)
+            environ['CONTENT_LENGTH'] = str(len(data))
+            del environ['HTTP_CONTENT_ENCODING']
+        return self.app(environ, start_response)
@@ -0,0 +1,192 @@
+# Copyright (C) 2018  The Software Heritage developers
+# See the AUTHORS file at the top-level directory of this distribution
+# License: GNU General Public License version 3, or any later version
+# See top-level LICENSE file for more information
+
+import logging
+import os
+import subprocess
+
+from swh.model.from_disk import mode_to_perms
+from swh.model.hashutil import hash_to_bytes
+
+
+logger = logging.getLogger(__name__)
+
+
+# Attributes making git convert the files between the index and the work
+# tree: their blob ids do not match the bytes on disk
+CONVERSION_ATTRIBUTES = ['text', 'eol', 'crlf', 'filter', 'ident',
+                         'working-tree-encoding']
+
+
+def git_output(path, *args, input=None):
+    """Run a git command in the work tree at `path`, and return its output.
+
+    """
+    return subprocess.check_output(['git'] + list(args), cwd=path,
+                                   input=input, stderr=subprocess.DEVNULL)
+
+
+def git_config(path, key):
+    """Get the value of the configuration `key` of the work tree at `path`.
+
+    Returns:
+        bytes: the value, or None if `key` is not set
+
+    """
+    try:
+        return git_output(path, 'config', '--get', key).strip()
+    except subprocess.CalledProcessError as e:
+        if e.returncode == 1:  # not set
+            return None
+        raise
+
+
+def git_ls_files(path):
+    """List the files tracked in the index of the work tree at `path`.
+
+    Files git is told not to check (assume-unchanged and skip-worktree
+    entries) are left out, as they may differ from the index.
+
+    Yields:
+        Tuple of (int mode, bytes sha1_git, int size, bytes path), where
+        size is the file size recorded in the index, truncated to 32 bits
+
+    """
+    records = git_output(path, 'ls-files', '--stage', '-v', '-t', '--debug',
+                         '-z').split(b'\0')
+    header = records[0]
+    for record in records[1:]:
+        # the five debug lines of the entry, then the header of the next one
+        *debug, next_header = record.split(b'\n', 5)
+        info, filepath = header.split(b'\t', 1)
+        tag, mode, hex_sha1, stage = info.split(b' ')
+        header = next_header
+        if stage != b'0':  # unmerged path
+            continue
+        if tag.islower() or tag == b'S':  # assume-unchanged, skip-worktree
+            continue
+        size = int(debug[4].split()[1])
+        yield (int(mode, 8), hash_to_bytes(hex_sha1.decode()), size,
+               filepath)
+
+
+def git_dirty_files(path):
+    """List the tracked files of the work tree at `path` which differ from
+    the index or from HEAD.
+
+    Returns:
+        set: the paths of the dirty files
+
+    """
+    dirty = set()
+    records = iter(git_output(path, 'status', '--porcelain', '-z',
+                              '--untracked-files=no',
+                              '--ignore-submodules').split(b'\0'))
+    for record in records:
+        if not record:
+            continue
+        dirty.add(record[3:])
+        if record[0:1] in b'RC':  # followed by the original path
+            dirty.add(next(records))
+    return dirty
+
+
+def git_converted_files(path, filepaths):
+    """List the files among `filepaths`, in the work tree at `path`, which
+    have conversion attributes set (see :data:`CONVERSION_ATTRIBUTES`).
+
+    Returns:
+        set: the paths of the converted files
+
+    """
+    if not filepaths:
+        return set()
+
+    converted = set()
+    fields = git_output(path, 'check-attr', '-z', '--stdin',
+                        *CONVERSION_ATTRIBUTES,
+                        input=b'\0'.join(filepaths) + b'\0').split(b'\0')
+    # (path, attribute, value) triplets
+    for filepath, _, value in zip(*[iter(fields)] * 3):
+        if value not in (b'unspecified', b'unset'):
+            converted.add(filepath)
+    return converted
+
+
+class GitIndex:
+    """The blob ids of the clean files of a git work tree.
+
+    Software Heritage content ids (`sha1_git`) are git blob ids, so clean
+    files do not need to be read to compute them. This does not hold for
+    the files git converts (end of lines, filters, ident expansion), which
+    are reported clean while their blob ids do not match their bytes on
+    disk: they are left out of the index.
+
+    Args:
+        blobs (dict): a mapping from the paths of clean files, relative to
+          the work tree root, to tuples of (mode, sha1_git, size)
+
+    """
+    def __init__(self, blobs):
+        self.blobs = blobs
+
+    @classmethod
+    def from_path(cls, path):
+        """Read the index of the git work tree rooted at `path`.
+
+        Returns:
+            GitIndex: the index, or None if `path` is not the root of a git
+            work tree, or if end of lines may be converted in all its files
+
+        """
+        if not os.path.exists(os.path.join(path, b'.git')):
+            return None
+
+        try:
+            autocrlf = git_config(path, 'core.autocrlf')
+            if autocrlf and autocrlf.lower() not in (b'false', b'no',
+                                                     b'off', b'0'):
+                logger.info('Not using the git index of %s, whose end of '
+                            'lines are converted', path)
+                return None
+
+            dirty = git_dirty_files(path)
+            blobs = {
+                filepath: (mode, sha1_git, size)
+                for mode, sha1_git, size, filepath in git_ls_files(path)
+                if filepath not in dirty
+            }
+            for filepath in git_converted_files(path, list(blobs)):
+                del blobs[filepath]
+        except (OSError, subprocess.CalledProcessError):
+            logger.warning('Cannot read the git index of %s', path,
+                           exc_info=True)
+            return None
+
+        return cls(blobs)
+
+    def sha1_git(self, relpath, file_stat):
+        """Get the blob id of the file at `relpath`.
+
+        Args:
+            relpath (bytes): path of the file, relative to the work tree root
+            file_stat (os.stat_result): the file's :func:`os.lstat`
+
+        Returns:
+            bytes: the blob id, or None if the file is not tracked, or
+            differs from the index
+
+        """
+        blob = self.blobs.get(relpath)
+        if not blob:
+            return None
+
+        mode, sha1_git, size = blob
+        if mode_to_perms(mode) != mode_to_perms(file_stat.st_mode):
+            return None
+        if size != file_stat.st_size & 0xffffffff:
+            return None
+
+        return sha1_git
@@ -4,14 +4,29 @@
 # See top-level LICENSE file for more information
 
 import os
+import time
 import uuid
 
+import requests
+
 from swh.loader.core import loader
+from swh.model.hashutil import hash_to_bytes, hash_to_hex
 from swh.model.identifiers import (release_identifier, revision_identifier,
                                    snapshot_identifier, identifier_to_bytes)
-from swh.model.from_disk import Directory
+from swh.storage.exc import StorageAPIError
 
 from . import converters
+from .batching import AdaptivePacketSizes
+from .compression import CompressedRemoteStorage
+from .git import GitIndex
+from .manifest import Manifest, ManifestTree, pack_manifest, save_manifest
+from .readahead import ReadScheduler
+from .spool import SpoolStorage, skipped_content_missing
+from .walker import ArchivedTree, DirectoryWalker
+
+
+# Errors of storage requests which may succeed with smaller packets
+STORAGE_ERRORS = (StorageAPIError, requests.exceptions.Timeout)
 
 
 def revision_from(directory_hash, revision):
@@ -58,12 +73,64 @@ class DirLoader(loader.BufferedLoader):
 
     visit_type = 'dir'
 
+    ADDITIONAL_CONFIG = {
+        # Files larger than this are not read, but archived as skipped
+        # contents
+        'content_size_limit': ('int', 100 * 1024 * 1024),
+        # Reuse the hashes of the previous visit for unchanged files
+        'incremental': ('bool', False),
+        # Take the content ids of clean files from the git index, when
+        # loading a git work tree
+        'git_index': ('bool', False),
+        # Only compute the sha1_git of the files up front, and their other
+        # hashes if they are missing from the archive
+        'deferred_hashes': ('bool', False),
+        # Read the files to hash in inode order, with readahead, e.g.
+        # {'readahead': 32, 'readers': 4}
+        'read_scheduler': ('dict', {}),
+        # Overrides of read_scheduler and content_packet_size_bytes (the
+        # memory budget of the contents), for the trees flagged as large by
+        # the size hint of the task, e.g.
+        # {'read_scheduler': {'readers': 8},
+        #  'content_packet_size_bytes': 4294967296}
+        'large_tree': ('dict', {}),
+        # Adapt the packet sizes to the storage latency, within bounds, e.g.
+        # {'target_latency': 5, 'content_packet_size': [1000, 50000]}
+        'adaptive_packets': ('dict', {}),
+        # Compress the contents sent to a remote storage, e.g.
+        # {'threshold': 65536, 'level': 6, 'workers': 2}
+        'content_compression': ('dict', {}),
+        # Write the objects to spools in this directory instead of sending
+        # them to the storage, for a later replay
+        'spool': ('str', ''),
+    }
+
     def __init__(self, logging_class='swh.loader.dir.DirLoader',
                  config=None):
         super().__init__(logging_class=logging_class, config=config)
+        compression = self.config.get('content_compression', {})
+        storage = self.config['storage']
+        if compression and storage['cls'] == 'remote':
+            self.storage = CompressedRemoteStorage(**storage['args'],
+                                                   **compression)
+        spool = self.config.get('spool', '')
+        if spool:
+            self.storage = SpoolStorage(spool)
+
+        self.configure_for_size(None)
+        self.previous_manifest = None
+        self.pending_manifest = None
+        self.listing_date = None
+
+        self.packet_sizes = None
+        adaptive_packets = self.config.get('adaptive_packets', {})
+        if adaptive_packets:
+            self.packet_sizes = AdaptivePacketSizes(adaptive_packets,
+                                                    self.config)
 
     def list_objs(self, *,
-                  dir_path, revision, release, branch_name):
+                  dir_path, revision, release, branch_name, archived=None,
+                  shards=None, manifest=None, save_manifest=None):
         """List all objects from dir_path.
 
         Args:
@@ -71,6 +138,18 @@ class DirLoader(loader.BufferedLoader):
             revision (dict): revision dictionary representation
             release (dict): release dictionary representation
             branch_name (str): branch name
+            archived (ArchivedTree): optional listing of the previously
+              archived version of dir_path (e.g. a
+              :class:`swh.loader.dir.manifest.ManifestTree`), whose
+              unchanged entries are not hashed nor collected again
+            shards (dict): optional mapping from the relative paths of
+              already loaded subdirectories to their ids
+            manifest (str): optional path of a manifest of dir_path (see
+              :mod:`swh.loader.dir.manifest`), listed instead of walking
+              dir_path
+            save_manifest (str): optional path to save the manifest of
+              dir_path to, along with its revision id, once its objects
+              are stored (see :func:`write_pending_manifest`)
 
         Returns:
             dict: a mapping from object types ('content', 'directory',
@@ -90,7 +169,28 @@ class DirLoader(loader.BufferedLoader):
         self.log.debug("Started listing {swh_repo}".format(**log_data),
                        extra=log_data)
 
-        directory = Directory.from_disk(path=dir_path, save_path=True)
+        git_index = None
+        if self.config.get('git_index', False):
+            git_index = GitIndex.from_path(dir_path)
+
+        walker = DirectoryWalker(save_path=True, archived=archived,
+                                 git_index=git_index,
+                                 known_directories=shards,
+                                 deferred_hashes=self.config.get(
+                                     'deferred_hashes', False),
+                                 read_scheduler=self.read_scheduler,
+                                 max_content_size=self.config[
+                                     'content_size_limit'])
+        if manifest:
+            with Manifest(manifest) as listing:
+                date = listing.date
+                directory, walker.partial_contents = \
+                    listing.to_directory(dir_path)
+        else:
+            date = time.time()
+            directory = walker.walk(dir_path)
+        walker.complete_contents(self.storage)
+        self.listing_date = date
         objects = directory.collect()
         if 'content' not in objects:
             objects['content'] = {}
@@ -102,6 +202,9 @@ class DirLoader(loader.BufferedLoader):
         objects['revision'] = {
             rev_id: full_rev
         }
+        if save_manifest:
+            self.pending_manifest = (save_manifest, pack_manifest(
+                directory, revision_id=rev_id, date=date))
 
         objects['release'] = {}
         if release and 'name' in release:
@@ -117,19 +220,80 @@ class DirLoader(loader.BufferedLoader):
             'swh_num_%s' % key: len(values)
             for key, values in objects.items()
         })
+        log_data.update({
+            'swh_num_%s' % key: value
+            for key, value in walker.counters.items()
+        })
 
         self.log.debug(("Done listing the objects in {swh_repo}: "
                         "{swh_num_content} contents, "
                         "{swh_num_directory} directories, "
                         "{swh_num_revision} revisions, "
                         "{swh_num_release} releases, "
-                        "{swh_num_snapshot} snapshot").format(**log_data),
+                        "{swh_num_snapshot} snapshot "
+                        "({swh_num_hashed} files hashed, "
+                        "{swh_num_reused} reused, "
+                        "{swh_num_git} from git, "
+                        "{swh_num_deferred} deferred, "
+                        "{swh_num_linked} hardlinks, saving "
+                        "{swh_num_linked_bytes} bytes, "
+                        "{swh_num_skipped} skipped)").format(**log_data),
                        extra=log_data)
 
         return objects
 
+    def load_shard(self, *, dir_path, shard, origin_id):
+        """Load the contents and directories of a subtree of dir_path, for
+        a sharded loading of dir_path.
+
+        No origin visit, revision nor snapshot is created: the root directory
+        of the subtree is then to be passed to :func:`load`, through its
+        `shards` argument.
+
+        Args:
+            dir_path (str): root of the directory being loaded
+            shard (str): path of the subtree, relative to dir_path
+            origin_id (int): identifier of the origin being loaded
+
+        Returns:
+            dict: the `path` of the subtree and the (hex) `id` of its root
+            directory, along with the walk counters
+
+        """
+        self.origin_id = origin_id
+        shard_path = os.path.join(os.fsencode(dir_path), os.fsencode(shard))
+
+        try:
+            walker = DirectoryWalker(
+                save_path=True,
+                deferred_hashes=self.config.get('deferred_hashes', False),
+                read_scheduler=self.read_scheduler,
+                max_content_size=self.config['content_size_limit'])
+            directory = walker.walk(shard_path)
+            walker.complete_contents(self.storage)
+            objects = directory.collect()
+
+            self.maybe_load_contents(objects.get('content', {}).values())
+            self.send_skipped_contents(
+                objects.get('skipped_content', {}).values())
+            self.maybe_load_directories(objects.get('directory', {}).values())
+            if self.config['send_contents']:
+                self.send_batch_contents(self.contents.pop())
+            if self.config['send_directories']:
+                self.send_batch_directories(self.directories.pop())
+
+            ret = dict(walker.counters)
+            ret.update({
+                'path': shard,
+                'id': hash_to_hex(directory.hash),
+            })
+            return ret
+        finally:
+            self.cleanup()
+
     def load(self, *, dir_path, origin, visit_date, revision, release,
-             branch_name=None):
+             branch_name=None, shards=None, size_hint=None,
+             previous_path=None, previous_manifest=None, save_manifest=None):
         """Load the content of the directory to the archive.
 
         Args:
@@ -146,20 +310,43 @@ class DirLoader(loader.BufferedLoader):
               `id`, `target` and `target_type` keys (computed from the
               revision)'
             branch_name (str): the optional branch_name to use for snapshot
+            shards (list): the results of :func:`load_shard` for the
+              subtrees of dir_path already loaded separately
+            size_hint (dict): the estimated size of dir_path, as returned
+              by :func:`swh.loader.dir.scan.estimate_tree_size`, along with
+              whether it is `large`
+            previous_path (str): optional path of the previous version of
+              dir_path, whose unchanged files are not hashed again: only
+              the files whose stat differs are. Without previous_manifest,
+              the hashes of the previous version are taken from the
+              previous visit of the origin
+            previous_manifest (str): optional path of the manifest saved
+              when loading the previous version of dir_path (see
+              save_manifest), listing its hashes and revision; ignored if
+              missing, e.g. after a failed load
+            save_manifest (str): optional path to save the manifest of
+              dir_path to, for the loading of its next version; it is only
+              saved once the load succeeded and all its objects are stored
 
         """
         # Yes, this is entirely redundant, but it allows us to document the
         # arguments and the entry point.
         return super().load(dir_path=dir_path, origin=origin,
                             visit_date=visit_date, revision=revision,
-                            release=release, branch_name=branch_name)
+                            release=release, branch_name=branch_name,
+                            shards=shards, size_hint=size_hint,
+                            previous_path=previous_path,
+                            previous_manifest=previous_manifest,
+                            save_manifest=save_manifest)
 
     def prepare_origin_visit(self, *, origin, visit_date=None, **kwargs):
         self.origin = origin
         self.visit_date = visit_date
 
     def prepare(self, *, dir_path, origin, revision, release, visit_date=None,
-                branch_name=None):
+                branch_name=None, shards=None, size_hint=None,
+                previous_path=None, previous_manifest=None,
+                save_manifest=None):
         """Prepare the loader for directory loading.
 
         Args: identical to :func:`load`.
@@ -185,11 +372,170 @@ class DirLoader(loader.BufferedLoader):
         if isinstance(self.dir_path, str):
             self.dir_path = os.fsencode(self.dir_path)
 
+        self.shards = {
+            os.fsencode(shard['path']): hash_to_bytes(shard['id'])
+            for shard in shards or []
+        }
+
+        self.configure_for_size(size_hint)
+
+        if previous_path is not None:
+            previous_path = os.fsencode(previous_path)
+        self.save_manifest = save_manifest
+
+        self.archived = None
+        if previous_manifest and os.path.exists(previous_manifest):
+            self.prepare_from_manifest(previous_manifest, previous_path)
+        elif (self.config.get('incremental', False)
+              or previous_path is not None):
+            self.prepare_incremental(previous_path)
+
+    def configure_for_size(self, size_hint):
+        """Pick the read scheduler and the memory budget of the contents
+        for a tree of the given size.
+
+        Args:
+            size_hint (dict): see :func:`load`
+
+        """
+        read_scheduler = self.config.get('read_scheduler', {})
+        max_size = self.config['content_packet_size_bytes']
+        if size_hint and size_hint.get('large'):
+            large_tree = self.config.get('large_tree', {})
+            read_scheduler = large_tree.get('read_scheduler', read_scheduler)
+            max_size = large_tree.get('content_packet_size_bytes', max_size)
+
+        self.read_scheduler = None
+        if read_scheduler:
+            self.read_scheduler = ReadScheduler(**read_scheduler)
+        self.contents.max_size = max_size
+
+    def get_previous_visit(self):
+        """Retrieve the last full visit of the origin with a snapshot.
+
+        Returns:
+            dict: the origin visit, or None for a new origin
+
+        """
+        visits = [visit
+                  for visit in self.storage.origin_visit_get(self.origin_id)
+                  if visit['status'] == 'full' and visit['snapshot']]
+        if not visits:
+            return None
+        return max(visits, key=lambda visit: visit['date'])
+
+    def prepare_incremental(self, previous_path=None):
+        """Fetch the revision and root directory the branch targeted at the
+        previous visit, so that only changed files are hashed again and the
+        new revision has the previous one as parent.
+
+        Args:
+            previous_path (bytes): optional path of the previous version of
+              the directory, see :class:`ArchivedTree`
+
+        """
+        visit = self.get_previous_visit()
+        if not visit:
+            return
+
+        branch_name = self.branch_name
+        if isinstance(branch_name, str):
+            branch_name = branch_name.encode('utf-8')
+
+        snapshot = self.storage.snapshot_get(visit['snapshot'])
+        branch = snapshot['branches'].get(branch_name) if snapshot else None
+        if not branch or branch['target_type'] != 'revision':
+            return
+
+        previous_revision = next(
+            self.storage.revision_get([branch['target']]))
+        if not previous_revision:
+            return
+
+        if 'parents' not in self.revision:
+            self.revision = dict(self.revision,
+                                 parents=[previous_revision['id']])
+
+        # the visit date is given by the caller, only the recorded start of
+        # the listing tells which files may have changed since
+        since = (visit.get('metadata') or {}).get('listing_date')
+        if since is None:
+            return
+
+        self.archived = ArchivedTree(
+            self.storage, previous_revision['directory'],
+            since=since, previous_path=previous_path)
+
+    def update_origin_visit(self, origin_id, visit, status):
+        """Update the status of the visit, recording the start of the
+        listing in its metadata for the next incremental visit.
+
+        """
+        metadata = None
+        if self.listing_date is not None:
+            metadata = {'listing_date': self.listing_date}
+        self.log.debug('Updating origin_visit for origin %s with status %s' %
+                       (origin_id, status))
+        self.storage.origin_visit_update(origin_id, visit, status,
+                                         metadata=metadata)
+
+    def prepare_from_manifest(self, manifest_path, previous_path=None):
+        """Map the manifest of the previous version of the directory, so
+        that only changed files are hashed again, only the new objects are
+        sent, and the new revision has the previous one as parent.
+
+        Args:
+            manifest_path (str): path of the manifest
+            previous_path (bytes): optional path of the previous version of
+              the directory, see :class:`ArchivedTree`
+
+        """
+        self.previous_manifest = Manifest(manifest_path)
+        self.archived = ManifestTree(self.previous_manifest,
+                                     previous_path=previous_path)
+
+        revision_id = self.previous_manifest.revision_id
+        if revision_id and 'parents' not in self.revision:
+            self.revision = dict(self.revision, parents=[revision_id])
+
+    def post_load(self, success=True):
+        """Drop the manifest of a failed load: it lists objects which may
+        not be stored.
+
+        """
+        if not success:
+            self.pending_manifest = None
+
+    def flush(self):
+        """Send the remaining objects, then save the manifest of the load,
+        if any, as all its objects are now stored.
+
+        """
+        super().flush()
+        self.write_pending_manifest()
+
+    def write_pending_manifest(self):
+        """Save the manifest built by :func:`list_objs`, if any.
+
+        The manifest lists the objects of the load as archived: it must
+        only be saved once they are all stored.
+
+        """
+        if self.pending_manifest:
+            path, manifest = self.pending_manifest
+            self.pending_manifest = None
+            save_manifest(path, manifest)
+
     def cleanup(self):
-        """Nothing to clean up.
+        """Unmap the manifest of the previous version, if any, and close the
+        spool files or the compression threads.
 
         """
-        pass
+        if self.previous_manifest:
+            self.previous_manifest.close()
+            self.previous_manifest = None
+        if isinstance(self.storage, (CompressedRemoteStorage, SpoolStorage)):
+            self.storage.close()
 
     def fetch_data(self):
         """Walk the directory, load all objects with their hashes.
@@ -200,17 +546,184 @@ class DirLoader(loader.BufferedLoader):
         self.objects = self.list_objs(dir_path=self.dir_path,
                                       revision=self.revision,
                                       release=self.release,
-                                      branch_name=self.branch_name)
+                                      branch_name=self.branch_name,
+                                      archived=self.archived,
+                                      shards=self.shards,
+                                      save_manifest=self.save_manifest)
 
     def store_data(self):
         objects = self.objects
         self.maybe_load_contents(objects['content'].values())
+        self.send_skipped_contents(
+            objects.get('skipped_content', {}).values())
         self.maybe_load_directories(objects['directory'].values())
         self.maybe_load_revisions(objects['revision'].values())
         self.maybe_load_releases(objects['release'].values())
         snapshot = list(objects['snapshot'].values())[0]
         self.maybe_load_snapshot(snapshot)
 
+        if self.packet_sizes:
+            log_data = {
+                'swh_type': 'dir_packet_sizes',
+                'swh_repo': self.dir_path.decode('utf-8'),
+            }
+            log_data.update({
+                'swh_%s' % key: value
+                for key, value in self.packet_sizes.summary().items()
+            })
+            log_data.update({
+                'swh_%s' % key: self.get_packet_size(key)
+                for key in ['content_packet_size',
+                            'content_packet_size_bytes',
+                            'directory_packet_size']
+            })
+            self.log.info(("Packet sizes for {swh_repo}: "
+                           "{swh_content_packet_size} contents, "
+                           "{swh_content_packet_size_bytes} bytes, "
+                           "{swh_directory_packet_size} directories").format(
+                               **log_data),
+                          extra=log_data)
+
+    def send_contents(self, content_list):
+        start = time.monotonic()
+        try:
+            super().send_contents(content_list)
+        except STORAGE_ERRORS:
+            if not self.reduce_packet_sizes('content'):
+                raise
+            self.log.warning('Sending %s contents failed, retrying with '
+                             'smaller packets', len(content_list))
+            for packet in self.content_packets(content_list):
+                self.send_contents(packet)
+            return
+
+        if self.packet_sizes and content_list:
+            self.packet_sizes.observe(
+                'content', time.monotonic() - start, len(content_list),
+                sum(content['length'] for content in content_list))
+
+    def send_skipped_contents(self, contents):
+        """Send the skipped contents found by the walk, which are missing
+        from the storage.
+
+        They bypass :func:`maybe_load_contents`, as the storage keeps them
+        apart from the other contents (see
+        :func:`swh.loader.dir.spool.skipped_content_missing`).
+
+        """
+        if not self.config['send_contents']:
+            return
+
+        contents = skipped_content_missing(self.storage, [
+            dict(content, origin=self.origin_id) for content in contents])
+        if contents:
+            # not accounted for by the adaptive packet sizes
+            super().send_contents(contents)
+
+    def send_directories(self, directory_list):
+        start = time.monotonic()
+        try:
+            super().send_directories(directory_list)
+        except STORAGE_ERRORS:
+            if not self.reduce_packet_sizes('directory'):
+                raise
+            self.log.warning('Sending %s directories failed, retrying with '
+                             'smaller packets', len(directory_list))
+            for packet in self.directory_packets(directory_list):
+                self.send_directories(packet)
+            return
+
+        if self.packet_sizes and directory_list:
+            self.packet_sizes.observe(
+                'directory', time.monotonic() - start, len(directory_list))
+
+    def reduce_packet_sizes(self, object_type):
+        """Reduce the adapted packet sizes of `object_type`, after a failed
+        request.
+
+        Returns:
+            bool: whether the objects of the failed request should be sent
+            again, in packets of the reduced sizes
+
+        """
+        if not self.packet_sizes:
+            return False
+        return self.packet_sizes.observe_failure(object_type)
+
+    def content_packets(self, contents):
+        """Split contents in packets of the current (possibly adapted)
+        sizes.
+
+        Yields:
+            list: packets of contents
+
+        """
+        # the packet sizes change as packets are sent
+        packet = []
+        packet_bytes = 0
+        for content in contents:
+            packet.append(content)
+            packet_bytes += content['length']
+            if len(packet) >= self.get_packet_size('content_packet_size') \
+               or packet_bytes > self.get_packet_size(
+                   'content_packet_size_bytes'):
+                yield packet
+                packet = []
+                packet_bytes = 0
+
+        if packet:
+            yield packet
+
+    def send_batch_contents(self, contents):
+        """Send contents batches to the storage, in packets of the current
+        (possibly adapted) sizes, compressed ahead of their upload if the
+        storage supports it.
+
+        """
+        packets = self.content_packets(contents)
+        if isinstance(self.storage, CompressedRemoteStorage):
+            packets = self.storage.prefetch(packets)
+
+        for packet in packets:
+            self.send_contents(packet)
+
+    def directory_packets(self, directories):
+        """Split directories in packets of the current (possibly adapted)
+        size.
+
+        Yields:
+            list: packets of directories
+
+        """
+        packet = []
+        for directory in directories:
+            packet.append(directory)
+            if len(packet) >= self.get_packet_size('directory_packet_size'):
+                yield packet
+                packet = []
+
+        if packet:
+            yield packet
+
+    def send_batch_directories(self, directories):
+        """Send directories batches to the storage, in packets of the
+        current (possibly adapted) size.
+
+        """
+        if not self.packet_sizes:
+            return super().send_batch_directories(directories)
+
+        for packet in self.directory_packets(directories):
+            self.send_directories(packet)
+
+    def get_packet_size(self, key):
+        """Get the current size of the packets configured by `key`.
+
+        """
+        if self.packet_sizes:
+            return self.packet_sizes.get(key, self.config[key])
+        return self.config[key]
+
 
 if __name__ == '__main__':
     import click
@@ -0,0 +1,467 @@
+# Copyright (C) 2018  The Software Heritage developers
+# See the AUTHORS file at the top-level directory of this distribution
+# License: GNU General Public License version 3, or any later version
+# See top-level LICENSE file for more information
+
+"""Compact binary manifests of directory listings.
+
+A manifest holds the contents and directories of a tree, as listed by the
+loader, in a file which can be memory-mapped and queried without being
+parsed. All the integers are little-endian:
+
+- a header: magic, version, number of contents, directories and entries,
+  size of the name pool, id of the root directory, id of the revision it
+  was loaded as and date of the listing (both zero when unknown)
+- the contents, sorted by `sha1_git`: fixed-width hashes, length and flags
+  telling which hashes are known
+- the directories, sorted by id: id and range of their entries
+- the directory entries: name (offset and length in the pool), target,
+  perms and type
+- the name pool: the entry names, each stored once
+
+As the contents and the directories are sorted by id, looking them up is a
+binary search and comparing two manifests is a linear merge.
+
+"""
+
+import mmap
+import os
+import stat
+import struct
+
+from swh.model.from_disk import Content, DentryPerms, Directory
+
+from .walker import ArchivedTree, KnownDirectory, SkippedContent
+
+MAGIC = b'SWHMANIF'
+VERSION = 2
+
+HEADER = struct.Struct('<8sIIIII20s20sd')
+CONTENT = struct.Struct('<20s20s32s32sQB7x')
+DIRECTORY = struct.Struct('<20sII')
+ENTRY = struct.Struct('<II20sIB3x')
+
+# the hashes of a content record, in order, with their flag
+CONTENT_HASHES = [('sha1', 1), ('sha256', 2), ('blake2s256', 4)]
+SKIPPED = 8
+
+ENTRY_TYPES = ['file', 'dir', 'rev']
+
+NO_ID = b'\x00' * 20
+
+
+def iter_nodes(directory):
+    """Iterate over the nodes of the tree rooted at `directory`, each
+    node being only yielded once.
+
+    """
+    seen = set()
+    stack = [directory]
+    while stack:
+        node = stack.pop()
+        if id(node) in seen:
+            continue
+        seen.add(id(node))
+        yield node
+        stack.extend(node.values())
+
+
+def pack_manifest(directory, *, revision_id=None, date=None):
+    """Build the manifest of the tree rooted at `directory`.
+
+    The subtrees loaded separately (see
+    :class:`swh.loader.dir.walker.KnownDirectory`) are not part of the
+    manifest.
+
+    Args:
+        directory (Directory): the root of the tree, as built by
+          :class:`swh.loader.dir.walker.DirectoryWalker`
+        revision_id (bytes): id of the revision the tree was loaded as
+        date (float): timestamp of the start of the listing: the files
+          changed after it may not match the manifest
+
+    Returns:
+        bytes: the manifest
+
+    """
+    contents = {}
+    directories = {}
+    for node in iter_nodes(directory):
+        if isinstance(node, Content):
+            contents[node.hash] = node
+        elif not isinstance(node, KnownDirectory):
+            directories[node.hash] = node.entries
+
+    pool = bytearray()
+    names = {}
+    entries = []
+    directory_records = []
+    for dir_id in sorted(directories):
+        dir_entries = directories[dir_id]
+        directory_records.append(
+            DIRECTORY.pack(dir_id, len(entries), len(dir_entries)))
+        for entry in dir_entries:
+            name = entry['name']
+            if name not in names:
+                names[name] = len(pool)
+                pool.extend(name)
+            entries.append(ENTRY.pack(
+                names[name], len(name), entry['target'], entry['perms'],
+                ENTRY_TYPES.index(entry['type'])))
+
+    records = [HEADER.pack(MAGIC, VERSION, len(contents), len(directories),
+                           len(entries), len(pool), directory.hash,
+                           revision_id or NO_ID, date or 0)]
+    for sha1_git in sorted(contents):
+        data = contents[sha1_git].data
+        flags = SKIPPED if isinstance(contents[sha1_git],
+                                      SkippedContent) else 0
+        hashes = []
+        for hash_name, flag in CONTENT_HASHES:
+            if data.get(hash_name):
+                flags |= flag
+            hashes.append(data.get(hash_name) or b'')
+        records.append(CONTENT.pack(sha1_git, *hashes, data['length'], flags))
+    records.extend(directory_records)
+    records.extend(entries)
+    records.append(bytes(pool))
+    return b''.join(records)
+
+
+def save_manifest(path, manifest):
+    """Save the manifest built by :func:`pack_manifest` to `path`.
+
+    An existing manifest at `path` is replaced atomically, so that it can
+    still be mapped while being replaced.
+
+    """
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(manifest)
+    os.replace(tmp_path, path)
+
+
+def write_manifest(path, directory, **kwargs):
+    """Write the manifest of the tree rooted at `directory` to `path`.
+
+    Args: see :func:`pack_manifest`
+
+    """
+    save_manifest(path, pack_manifest(directory, **kwargs))
+
+
+class Manifest:
+    """A memory-mapped manifest.
+
+    Args:
+        path: path of the manifest file
+
+    """
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        (magic, version, self.num_contents, self.num_directories,
+         num_entries, pool_size, self.root_id, revision_id,
+         self.date) = HEADER.unpack_from(self.map)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError('%r is not a manifest (version %s)' %
+                             (path, VERSION))
+        self.revision_id = None if revision_id == NO_ID else revision_id
+
+        self.contents_offset = HEADER.size
+        self.directories_offset = \
+            self.contents_offset + self.num_contents * CONTENT.size
+        self.entries_offset = \
+            self.directories_offset + self.num_directories * DIRECTORY.size
+        self.pool_offset = self.entries_offset + num_entries * ENTRY.size
+
+    def close(self):
+        self.map.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def content_id(self, i):
+        offset = self.contents_offset + i * CONTENT.size
+        return self.map[offset:offset+20]
+
+    def directory_id(self, i):
+        offset = self.directories_offset + i * DIRECTORY.size
+        return self.map[offset:offset+20]
+
+    def content(self, i):
+        """Get the `i`-th content of the manifest, in `sha1_git` order.
+
+        Returns:
+            dict: the known hashes and the length of the content, with an
+            `absent` status if it was skipped
+
+        """
+        sha1_git, *hashes, length, flags = CONTENT.unpack_from(
+            self.map, self.contents_offset + i * CONTENT.size)
+        content = {'sha1_git': sha1_git, 'length': length}
+        for (hash_name, flag), value in zip(CONTENT_HASHES, hashes):
+            if flags & flag:
+                content[hash_name] = value
+        if flags & SKIPPED:
+            content.update({'status': 'absent',
+                            'reason': 'Content too large'})
+        return content
+
+    def directory(self, i):
+        """Get the `i`-th directory of the manifest, in id order.
+
+        Returns:
+            dict: the `id` and `entries` of the directory
+
+        """
+        dir_id, first, count = DIRECTORY.unpack_from(
+            self.map, self.directories_offset + i * DIRECTORY.size)
+        entries = []
+        for j in range(first, first + count):
+            name_offset, name_length, target, perms, type_id = \
+                ENTRY.unpack_from(self.map,
+                                  self.entries_offset + j * ENTRY.size)
+            name_offset += self.pool_offset
+            entries.append({
+                'name': self.map[name_offset:name_offset+name_length],
+                'type': ENTRY_TYPES[type_id],
+                'target': target,
+                'perms': DentryPerms(perms),
+            })
+        return {'id': dir_id, 'entries': entries}
+
+    def content_ids(self):
+        """Iterate over the content ids, in order."""
+        return (self.content_id(i) for i in range(self.num_contents))
+
+    def directory_ids(self):
+        """Iterate over the directory ids, in order."""
+        return (self.directory_id(i) for i in range(self.num_directories))
+
+    def contents(self):
+        return (self.content(i) for i in range(self.num_contents))
+
+    def directories(self):
+        return (self.directory(i) for i in range(self.num_directories))
+
+    def _find(self, get_id, num, obj_id):
+        low, high = 0, num
+        while low < high:
+            middle = (low + high) // 2
+            if get_id(middle) < obj_id:
+                low = middle + 1
+            else:
+                high = middle
+        if low < num and get_id(low) == obj_id:
+            return low
+        return None
+
+    def find_content(self, sha1_git):
+        """Look up a content by `sha1_git`.
+
+        Returns:
+            dict: the content (see :func:`content`), or None
+
+        """
+        i = self._find(self.content_id, self.num_contents, sha1_git)
+        return None if i is None else self.content(i)
+
+    def find_directory(self, dir_id):
+        """Look up a directory by id.
+
+        Returns:
+            dict: the directory (see :func:`directory`), or None
+
+        """
+        i = self._find(self.directory_id, self.num_directories, dir_id)
+        return None if i is None else self.directory(i)
+
+    def paths(self, root=b''):
+        """Iterate over the paths of the tree, from the root directory.
+
+        Yields:
+            tuple: the path (relative to `root`) and the directory entry
+            of each file and directory of the tree
+
+        """
+        stack = [(root, self.root_id)]
+        while stack:
+            path, dir_id = stack.pop()
+            directory = self.find_directory(dir_id)
+            if directory is None:
+                # loaded separately
+                continue
+            for entry in directory['entries']:
+                entry_path = os.path.join(path, entry['name'])
+                yield entry_path, entry
+                if entry['type'] == 'dir':
+                    stack.append((entry_path, entry['target']))
+
+    def to_directory(self, root):
+        """Rebuild the tree of the manifest, for the files found at `root`.
+
+        The contents whose hashes are not all known need to be completed,
+        see :func:`swh.loader.dir.walker.DirectoryWalker.complete_contents`.
+
+        Args:
+            root (bytes): where the files of the tree are
+
+        Returns:
+            tuple: the root :class:`Directory`, and the list of (content,
+            path) of the incomplete contents
+
+        """
+        contents = {}
+        partial_contents = []
+        directories = {}
+
+        def build(path, dir_id):
+            listing = self.find_directory(dir_id)
+            if listing is None:
+                # loaded separately
+                return KnownDirectory(dir_id)
+
+            directory = Directory({'name': os.path.basename(path)})
+            for entry in listing['entries']:
+                entry_path = os.path.join(path, entry['name'])
+                target = entry['target']
+                if entry['type'] == 'dir':
+                    if target not in directories:
+                        directories[target] = build(entry_path, target)
+                    directory[entry['name']] = directories[target]
+                    continue
+
+                # the same blob may be a file of different permissions, or
+                # the target of a symbolic link
+                key = (target, entry['perms'])
+                if key not in contents or stat.S_ISLNK(entry['perms']):
+                    data = self.find_content(target)
+                    data['perms'] = entry['perms']
+                    if stat.S_ISLNK(entry['perms']):
+                        data['data'] = os.readlink(entry_path)
+                    elif data['length'] == 0:
+                        # do not open special files, archived as empty
+                        data['data'] = b''
+                    else:
+                        data['path'] = entry_path
+                    if data.get('status') == 'absent':
+                        content = SkippedContent(data)
+                    else:
+                        content = Content(data)
+                    if not data.keys() >= {'sha1', 'sha256', 'blake2s256'}:
+                        partial_contents.append((content, entry_path))
+                    contents[key] = content
+                directory[entry['name']] = contents[key]
+            return directory
+
+        return build(root, self.root_id), partial_contents
+
+
+class ManifestTree(ArchivedTree):
+    """The tree listed in a manifest, e.g. saved when loading a previous
+    version of the tree, used to avoid hashing again the entries which did
+    not change since.
+
+    The objects of the tree are assumed to be archived already.
+
+    Args:
+        manifest (Manifest): the manifest of the previous version
+        previous_path (bytes): optional path of the previous version, see
+          :class:`swh.loader.dir.walker.ArchivedTree`
+
+    """
+    def __init__(self, manifest, *, previous_path=None):
+        super().__init__(None, manifest.root_id, since=manifest.date,
+                         previous_path=previous_path)
+        self.manifest = manifest
+
+    def list_directory(self, dir_id):
+        directory = self.manifest.find_directory(dir_id)
+        if directory is None:
+            # loaded separately, its entries are unknown
+            return []
+
+        entries = directory['entries']
+        for entry in entries:
+            if entry['type'] == 'file':
+                content = self.manifest.find_content(entry['target'])
+                entry.update({
+                    'length': content['length'],
+                    'sha1': content.get('sha1'),
+                    'sha256': content.get('sha256'),
+                    'blake2s256': content.get('blake2s256'),
+                    'status': content.get('status', 'visible'),
+                })
+        return entries
+
+    def content(self, relpath, file_stat):
+        """Build the content for the file at `relpath` out of the
+        manifest, if the file did not change since it was listed.
+
+        Unlike the archived listings, the manifest may only know the
+        `sha1_git` of the content, which is enough as it is not sent again.
+
+        """
+        entry = self.unchanged_entry(relpath, file_stat)
+        if not entry or entry['status'] == 'absent':
+            return None
+
+        data = {
+            'sha1_git': entry['target'],
+            'length': entry['length'],
+            'perms': entry['perms'],
+        }
+        for hash_name, _ in CONTENT_HASHES:
+            if entry[hash_name]:
+                data[hash_name] = entry[hash_name]
+        content = Content(data)
+        # already archived, nothing to send
+        content.collected = True
+        return content
+
+
+def diff_ids(old_ids, new_ids):
+    """Compare two sorted iterables of ids, in a single pass.
+
+    Returns:
+        tuple: the lists of the ids only in `new_ids` (added), and of the
+        ids only in `old_ids` (removed)
+
+    """
+    added = []
+    removed = []
+    old_ids = iter(old_ids)
+    new_ids = iter(new_ids)
+    old = next(old_ids, None)
+    new = next(new_ids, None)
+    while old is not None or new is not None:
+        if new is None or (old is not None and old < new):
+            removed.append(old)
+            old = next(old_ids, None)
+        elif old is None or new < old:
+            added.append(new)
+            new = next(new_ids, None)
+        else:
+            old = next(old_ids, None)
+            new = next(new_ids, None)
+    return added, removed
+
+
+def diff_manifests(old, new):
+    """Compare two manifests, without reading nor hashing any file.
+
+    Returns:
+        dict: for 'content' and 'directory', the `added` and `removed` ids
+
+    """
+    ret = {}
+    for object_type, ids in [('content', Manifest.content_ids),
+                             ('directory', Manifest.directory_ids)]:
+        added, removed = diff_ids(ids(old), ids(new))
+        ret[object_type] = {'added': added, 'removed': removed}
+    return ret
@@ -0,0 +1,116 @@
+# Copyright (C) 2018  The Software Heritage developers
+# See the AUTHORS file at the top-level directory of this distribution
+# License: GNU General Public License version 3, or any later version
+# See top-level LICENSE file for more information
+
+import collections
+import os
+import stat
+
+from concurrent.futures import ThreadPoolExecutor
+
+from swh.model.hashutil import DEFAULT_ALGORITHMS, MultiHash
+
+# Never block on FIFOs, nor follow symbolic links, which could have replaced
+# the regular files found by the walk
+OPEN_FLAGS = os.O_RDONLY | os.O_NONBLOCK | getattr(os, 'O_NOFOLLOW', 0)
+
+
+def hash_regular_file(path, hash_names=DEFAULT_ALGORITHMS):
+    """Hash the regular file at `path`.
+
+    Returns:
+        dict: the hashes, as returned by
+        :func:`swh.model.hashutil.MultiHash.digest`
+
+    Raises:
+        ValueError: if `path` is not a regular file (anymore)
+
+    """
+    fd = os.open(path, OPEN_FLAGS)
+    with open(fd, 'rb') as f:
+        file_stat = os.fstat(fd)
+        if not stat.S_ISREG(file_stat.st_mode):
+            raise ValueError('%r is not a regular file' % path)
+        return MultiHash.from_file(f, hash_names=hash_names,
+                                   length=file_stat.st_size).digest()
+
+
+def advise_willneed(path):
+    """Hint the kernel that the file at `path` is about to be read, so that
+    it starts reading it ahead.
+
+    This is a no-op where :func:`os.posix_fadvise` is not available.
+
+    """
+    if not hasattr(os, 'posix_fadvise'):
+        return
+
+    try:
+        fd = os.open(path, OPEN_FLAGS)
+    except OSError:
+        return
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+class ReadScheduler:
+    """Schedule the reads of files to hash, for trees on slow storage
+    (spinning disks, cold network file systems).
+
+    The files are read in inode order, which approximates their on-disk
+    order on most file systems, rather than in name order. The kernel is
+    asked to read the next `readahead` files ahead of the readers.
+
+    Args:
+        readahead (int): number of files to read ahead
+        readers (int): number of files read and hashed concurrently
+
+    """
+    def __init__(self, *, readahead=32, readers=1):
+        self.readahead = readahead
+        self.readers = readers
+
+    def hash_files(self, files, hash_names=DEFAULT_ALGORITHMS):
+        """Hash the given files.
+
+        Args:
+            files (list): (path, file_stat) couples, `file_stat` being the
+              :func:`os.lstat` of the regular file at `path`
+            hash_names (set): the hashes to compute
+
+        Returns:
+            list: the hashes of the files, as returned by
+            :func:`swh.model.hashutil.MultiHash.digest`, in the order of
+            `files`
+
+        """
+        order = sorted(range(len(files)),
+                       key=lambda i: (files[i][1].st_dev, files[i][1].st_ino))
+
+        def hash_file(path):
+            return hash_regular_file(path, hash_names=hash_names)
+
+        results = [None] * len(files)
+        with ThreadPoolExecutor(max_workers=self.readers) as executor:
+            pending = collections.deque()
+            advised = 0
+            for position, i in enumerate(order):
+                # keep the kernel `readahead` files ahead of the readers
+                while advised < min(len(order), position + self.readahead):
+                    advise_willneed(files[order[advised]][0])
+                    advised += 1
+
+                pending.append((i, executor.submit(hash_file, files[i][0])))
+                if len(pending) > self.readers:
+                    j, future = pending.popleft()
+                    results[j] = future.result()
+
+            for j, future in pending:
+                results[j] = future.result()
+
+        return results
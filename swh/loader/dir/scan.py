@@ -0,0 +1,89 @@
+# Copyright (C) 2018  The Software Heritage developers
+# See the AUTHORS file at the top-level directory of this distribution
+# License: GNU General Public License version 3, or any later version
+# See top-level LICENSE file for more information
+
+"""Cheap estimation of the size of a directory tree, to be run when
+scheduling its loading.
+
+This module only depends on the standard library, so that it can be
+imported by the task module.
+
+"""
+
+import os
+import random
+
+# Trees above any of these sizes are loaded by the large workers
+LARGE_TREE = {
+    'files': 100000,
+    'bytes': 10 * 1024 ** 3,
+}
+
+
+def estimate_tree_size(path, *, sample=None, seed=0):
+    """Estimate the number of files and the total size of the tree rooted
+    at `path`, out of :func:`os.scandir` (no file is opened).
+
+    When `sample` is set, each subdirectory is only scanned with that
+    probability, the counts of the scanned subtrees being scaled up
+    accordingly. The top-level directory is always scanned.
+
+    Args:
+        path (bytes): root of the tree
+        sample (float): probability to scan each subdirectory, or None to
+          scan the whole tree
+        seed (int): seed of the sampling
+
+    Returns:
+        dict: the (estimated) numbers of `files` (including symbolic links
+        and special files) and `directories`, the `bytes` of the files, and
+        whether the tree was `sampled`
+
+    """
+    rand = random.Random(seed)
+    files = directories = size = 0.0
+
+    # directories to scan, with the weight of their entries
+    pending = [(path, 1.0)]
+    while pending:
+        dir_path, weight = pending.pop()
+        try:
+            entries = list(os.scandir(dir_path))
+        except OSError:
+            continue
+
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                directories += weight
+                if sample is None:
+                    pending.append((entry.path, weight))
+                elif rand.random() < sample:
+                    pending.append((entry.path, weight / sample))
+                continue
+
+            files += weight
+            try:
+                size += weight * entry.stat(follow_symlinks=False).st_size
+            except OSError:
+                continue
+
+    return {
+        'files': round(files),
+        'directories': round(directories),
+        'bytes': round(size),
+        'sampled': sample is not None,
+    }
+
+
+def is_large_tree(size, thresholds=None):
+    """Check whether a tree of the given (estimated) `size` is large.
+
+    Args:
+        size (dict): as returned by :func:`estimate_tree_size`
+        thresholds (dict): maximal `files` and `bytes` of the small trees,
+          :data:`LARGE_TREE` by default
+
+    """
+    thresholds = thresholds or LARGE_TREE
+    return any(size[key] > value for key, value in thresholds.items())
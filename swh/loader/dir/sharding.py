@@ -0,0 +1,36 @@
+# Copyright (C) 2018  The Software Heritage developers
+# See the AUTHORS file at the top-level directory of this distribution
+# License: GNU General Public License version 3, or any later version
+# See top-level LICENSE file for more information
+
+import os
+
+
+def split_tree(path, depth=1):
+    """Split the tree rooted at `path` in subtrees which can be loaded
+    independently.
+
+    Args:
+        path (bytes): root of the tree
+        depth (int): depth of the subtrees' roots, relative to `path`
+
+    Returns:
+        list: the paths of the subtrees' roots, relative to `path`. Files
+        and directories above `depth` are not part of any subtree.
+
+    """
+    shards = []
+    for root, dentries, fentries in os.walk(path):
+        relroot = os.path.relpath(root, path)
+        level = 0 if relroot == b'.' else relroot.count(b'/') + 1
+        if level + 1 < depth:
+            continue
+
+        # symbolic links to directories are contents
+        shards.extend(
+            os.path.join(relroot, name) if level else name
+            for name in dentries
+            if not os.path.islink(os.path.join(root, name)))
+        dentries.clear()
+
+    return sorted(shards)
@@ -0,0 +1,413 @@
+# Copyright (C) 2018  The Software Heritage developers
+# See the AUTHORS file at the top-level directory of this distribution
+# License: GNU General Public License version 3, or any later version
+# See top-level LICENSE file for more information
+
+"""Offline loading: the objects of a visit are written to a local spool,
+which is replayed to the storage later on.
+
+A spool is a pair of append-only files:
+
+- `<name>.pack`: the records, each made of a header (record type, length)
+  followed by the msgpack-encoded object
+- `<name>.idx`: one fixed-size entry per record (record type, object id,
+  offset of the record in the pack)
+
+Both files are flushed after each write, so that the objects spooled by a
+failed visit are not lost.
+
+"""
+
+import glob
+import itertools
+import os
+import struct
+import uuid
+
+from swh.core.serializers import msgpack_dumps, msgpack_loads
+
+# in replay order: a visit is only updated once its objects are stored
+RECORD_TYPES = [
+    'origin',
+    'origin_visit',
+    'content',
+    'directory',
+    'revision',
+    'release',
+    'snapshot',
+    'origin_visit_update',
+]
+
+RECORD_HEADER = struct.Struct('>BI')
+INDEX_ENTRY = struct.Struct('>B20sQ')
+NO_ID = b'\x00' * 20
+
+REPLAY_BATCH_SIZE = 10000
+REPLAY_BATCH_BYTES = 100 * 1024 * 1024
+
+
+class SpoolStorage:
+    """A write-only storage spooling the objects sent by a loader.
+
+    Only the storage methods used by the loaders are implemented. The
+    spool does not know about the archive: all the objects not already
+    spooled are reported missing, and the origins have no previous visit.
+
+    The spool files are opened on the first write, and reopened after
+    :func:`close` if written to again.
+
+    Args:
+        path (str): the directory holding the spools
+        name (str): name of the spool, random by default
+
+    """
+    def __init__(self, path, name=None):
+        if name is None:
+            name = uuid.uuid4().hex
+        os.makedirs(path, exist_ok=True)
+        self.prefix = os.path.join(path, name)
+        self.pack = self.index = None
+        self.ids = {record_type: set() for record_type in RECORD_TYPES}
+        self.origins = 0
+        self.visits = 0
+
+    def close(self):
+        if self.pack is not None:
+            self.pack.close()
+            self.index.close()
+            self.pack = self.index = None
+
+    def write(self, record_type, objects, key=None):
+        """Append `objects` to the spool, skipping the ones already spooled.
+
+        Args:
+            record_type (str): the type of the objects
+            objects (iterable): the objects to append
+            key (str): the key holding the objects' ids, if any
+
+        """
+        if self.pack is None:
+            self.pack = open(self.prefix + '.pack', 'ab')
+            self.index = open(self.prefix + '.idx', 'ab')
+
+        type_id = RECORD_TYPES.index(record_type)
+        ids = self.ids[record_type]
+        entries = []
+        for obj in objects:
+            obj_id = obj[key] if key else NO_ID
+            if key and obj_id in ids:
+                continue
+
+            data = msgpack_dumps(obj)
+            offset = self.pack.tell()
+            entries.append(INDEX_ENTRY.pack(type_id, obj_id, offset))
+            self.pack.write(RECORD_HEADER.pack(type_id, len(data)))
+            self.pack.write(data)
+            if key:
+                ids.add(obj_id)
+
+        # only index the records once they are written
+        self.pack.flush()
+        self.index.write(b''.join(entries))
+        self.index.flush()
+
+    def origin_add_one(self, origin):
+        self.origins += 1
+        self.write('origin', [dict(origin, id=self.origins)])
+        return self.origins
+
+    def origin_visit_add(self, origin, date=None):
+        self.visits += 1
+        self.write('origin_visit', [{
+            'origin': origin,
+            'visit': self.visits,
+            'date': date,
+        }])
+        return {'origin': origin, 'visit': self.visits}
+
+    def origin_visit_update(self, origin, visit_id, status, metadata=None):
+        self.write('origin_visit_update', [{
+            'origin': origin,
+            'visit': visit_id,
+            'status': status,
+            'metadata': metadata,
+        }])
+
+    def origin_visit_get(self, origin, last_visit=None, limit=None):
+        return iter([])
+
+    def fetch_history_start(self, origin_id):
+        return None
+
+    def fetch_history_end(self, fetch_history_id, data):
+        return None
+
+    def content_add(self, contents):
+        self.write('content', contents, key='sha1_git')
+
+    def directory_add(self, directories):
+        self.write('directory', directories, key='id')
+
+    def revision_add(self, revisions):
+        self.write('revision', revisions, key='id')
+
+    def release_add(self, releases):
+        self.write('release', releases, key='id')
+
+    def snapshot_add(self, origin, visit, snapshot):
+        self.write('snapshot', [{
+            'origin': origin,
+            'visit': visit,
+            'snapshot': snapshot,
+        }])
+
+    def content_missing(self, contents, key_hash='sha1'):
+        for content in contents:
+            if content['sha1_git'] not in self.ids['content']:
+                yield content[key_hash]
+
+    def directory_missing(self, directories):
+        return (dir_id for dir_id in directories
+                if dir_id not in self.ids['directory'])
+
+    def revision_missing(self, revisions):
+        return (rev_id for rev_id in revisions
+                if rev_id not in self.ids['revision'])
+
+    def release_missing(self, releases):
+        return (rel_id for rel_id in releases
+                if rel_id not in self.ids['release'])
+
+    def object_find_by_sha1_git(self, ids):
+        return {obj_id: [] for obj_id in ids}
+
+
+class Spool:
+    """Read access to a spool written by a :class:`SpoolStorage`.
+
+    Args:
+        prefix (str): path of the spool, without the `.pack` or `.idx`
+          extension
+
+    """
+    def __init__(self, prefix):
+        self.prefix = prefix
+
+    def entries(self):
+        """Read the index of the spool.
+
+        Yields:
+            tuple: the (record type, object id, offset) of each record, an
+            incomplete last entry (from an interrupted write) being ignored
+
+        """
+        with open(self.prefix + '.idx', 'rb') as f:
+            while True:
+                entry = f.read(INDEX_ENTRY.size)
+                if len(entry) < INDEX_ENTRY.size:
+                    break
+                type_id, obj_id, offset = INDEX_ENTRY.unpack(entry)
+                yield RECORD_TYPES[type_id], obj_id, offset
+
+    def objects(self, record_type):
+        """Read the objects of type `record_type` from the spool, in order.
+
+        """
+        offsets = [offset for entry_type, _, offset in self.entries()
+                   if entry_type == record_type]
+        with open(self.prefix + '.pack', 'rb') as f:
+            for offset in offsets:
+                f.seek(offset)
+                _, length = RECORD_HEADER.unpack(f.read(RECORD_HEADER.size))
+                yield msgpack_loads(f.read(length))
+
+
+def skipped_content_missing(storage, contents):
+    """List the skipped contents among `contents` which are missing from
+    `storage`.
+
+    Storages without a `skipped_content_missing` endpoint (the in-memory
+    one, the spools, the remote API client) look them up as contents.
+
+    Returns:
+        list: the missing skipped contents
+
+    """
+    if hasattr(storage, 'skipped_content_missing'):
+        missing = {content['sha1']
+                   for content in storage.skipped_content_missing(contents)}
+    else:
+        missing = set(storage.content_missing(contents, key_hash='sha1'))
+    return [content for content in contents if content['sha1'] in missing]
+
+
+def list_spools(path):
+    """List the spools found in the directory `path`, oldest first.
+
+    """
+    packs = sorted(glob.glob(os.path.join(path, '*.pack')),
+                   key=os.path.getmtime)
+    return [Spool(pack[:-len('.pack')]) for pack in packs]
+
+
+def batches(iterable, size, max_bytes=None, length=None):
+    """Split `iterable` in lists of at most `size` objects and, if
+    `max_bytes` is set, of at most `max_bytes` bytes as measured by the
+    `length` function (larger objects are batched alone).
+
+    """
+    if max_bytes is None:
+        iterator = iter(iterable)
+        while True:
+            batch = list(itertools.islice(iterator, size))
+            if not batch:
+                return
+            yield batch
+
+    batch = []
+    batch_bytes = 0
+    for obj in iterable:
+        obj_bytes = length(obj)
+        if batch and (len(batch) >= size
+                      or batch_bytes + obj_bytes > max_bytes):
+            yield batch
+            batch = []
+            batch_bytes = 0
+        batch.append(obj)
+        batch_bytes += obj_bytes
+
+    if batch:
+        yield batch
+
+
+def content_length(content):
+    """Number of bytes of data sent along with `content`.
+
+    """
+    if content.get('status') == 'absent':
+        return 0
+    return content['length']
+
+
+def replay(storage, spools, batch_size=REPLAY_BATCH_SIZE,
+           batch_bytes=REPLAY_BATCH_BYTES):
+    """Load the objects of `spools` into `storage`.
+
+    The objects of all the spools are sent together, in batches of
+    `batch_size` objects of the same type (and of `batch_bytes` bytes of
+    contents), only the objects missing from the storage being sent.
+    Origins and visits get new ids in the storage.
+
+    Args:
+        storage: the storage to load the objects into
+        spools (list): the :class:`Spool` objects to replay
+        batch_size (int): maximum number of objects sent at once
+        batch_bytes (int): maximum size of the contents sent at once
+
+    Returns:
+        dict: the number of objects of each type read from the spools
+
+    """
+    counters = {record_type: 0 for record_type in RECORD_TYPES}
+
+    # the origin and visit ids of each spool, in the storage
+    origins = {}
+    visits = {}
+    for i, spool in enumerate(spools):
+        for origin in spool.objects('origin'):
+            counters['origin'] += 1
+            spool_id = origin.pop('id')
+            origins[i, spool_id] = storage.origin_add_one(origin)
+        for visit in spool.objects('origin_visit'):
+            counters['origin_visit'] += 1
+            origin_id = origins[i, visit['origin']]
+            visits[i, visit['origin'], visit['visit']] = \
+                storage.origin_visit_add(origin_id, visit['date'])['visit']
+
+    def objects(record_type):
+        for spool in spools:
+            for obj in spool.objects(record_type):
+                counters[record_type] += 1
+                yield obj
+
+    for batch in batches(objects('content'), batch_size,
+                         max_bytes=batch_bytes, length=content_length):
+        contents = [content for content in batch
+                    if content.get('status') != 'absent']
+        missing = set(storage.content_missing(contents, key_hash='sha1'))
+        storage.content_add([content for content in contents
+                             if content['sha1'] in missing])
+
+        skipped_contents = skipped_content_missing(
+            storage, [content for content in batch
+                      if content.get('status') == 'absent'])
+        if skipped_contents:
+            storage.content_add(skipped_contents)
+
+    for record_type, missing in [('directory', storage.directory_missing),
+                                 ('revision', storage.revision_missing),
+                                 ('release', storage.release_missing)]:
+        add = getattr(storage, record_type + '_add')
+        for batch in batches(objects(record_type), batch_size):
+            missing_ids = set(missing([obj['id'] for obj in batch]))
+            add([obj for obj in batch if obj['id'] in missing_ids])
+
+    for i, spool in enumerate(spools):
+        for snapshot in spool.objects('snapshot'):
+            counters['snapshot'] += 1
+            storage.snapshot_add(
+                origins[i, snapshot['origin']],
+                visits[i, snapshot['origin'], snapshot['visit']],
+                snapshot['snapshot'])
+        for update in spool.objects('origin_visit_update'):
+            counters['origin_visit_update'] += 1
+            storage.origin_visit_update(
+                origins[i, update['origin']],
+                visits[i, update['origin'], update['visit']],
+                update['status'], update['metadata'])
+
+    return counters
+
+
+if __name__ == '__main__':
+    import click
+    import logging
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s %(process)d %(message)s'
+    )
+
+    @click.command()
+    @click.option('--storage-url', default='http://localhost:5002/',
+                  help='Url of the storage to replay the spools into')
+    @click.option('--batch-size', default=REPLAY_BATCH_SIZE,
+                  help='Number of objects sent at once')
+    @click.option('--batch-bytes', default=REPLAY_BATCH_BYTES,
+                  help='Maximum size of the contents sent at once')
+    @click.option('--remove/--keep', default=False,
+                  help='Remove the spools once replayed')
+    @click.argument('paths', nargs=-1, required=True)
+    def main(storage_url, batch_size, batch_bytes, remove, paths):
+        """Replay spools, or directories of spools, into the storage"""
+        from swh.storage import get_storage
+        storage = get_storage('remote', {'url': storage_url})
+
+        spools = []
+        for path in paths:
+            if os.path.isdir(path):
+                spools.extend(list_spools(path))
+            else:
+                spools.append(Spool(os.path.splitext(path)[0]))
+
+        counters = replay(storage, spools, batch_size=batch_size,
+                          batch_bytes=batch_bytes)
+        logging.info('Replayed %s spools: %s', len(spools), ', '.join(
+            '%s %s' % (num, record_type)
+            for record_type, num in counters.items()))
+
+        if remove:
+            for spool in spools:
+                os.unlink(spool.prefix + '.pack')
+                os.unlink(spool.prefix + '.idx')
+
+    main()
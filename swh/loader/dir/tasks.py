@@ -3,20 +3,124 @@
 # License: GNU General Public License version 3, or any later version
 # See top-level LICENSE file for more information
 
+import os
+
 from celery import current_app as app
 
-from swh.loader.dir.loader import DirLoader
+# Suffix of the queue of the tasks loading large trees
+LARGE_QUEUE_SUFFIX = '.large'
 
 
 @app.task(name=__name__ + '.LoadDirRepository')
 def load_directory(dir_path, origin, visit_date, revision, release,
-                   branch_name=None):
+                   branch_name=None, size_hint=None, previous_path=None,
+                   previous_manifest=None, save_manifest=None):
     """Import a directory to Software Heritage
 
     Import a directory dir_path with origin at visit_date time.
     Providing the revision, release, and occurrences.
 
+    When the previous version of the directory was loaded by the same
+    worker, its path (previous_path) and/or the manifest saved when loading
+    it (previous_manifest) let only the differences be hashed and sent.
+
+    """
+    # Imported here so that workers only routing tasks do not pay for
+    # loading the storage client stack
+    from swh.loader.dir.loader import DirLoader
+
+    return DirLoader().load(dir_path=dir_path, origin=origin,
+                            visit_date=visit_date, revision=revision,
+                            release=release, branch_name=branch_name,
+                            size_hint=size_hint, previous_path=previous_path,
+                            previous_manifest=previous_manifest,
+                            save_manifest=save_manifest)
+
+
+def schedule_load_directory(dir_path, origin, visit_date, revision, release,
+                            branch_name=None, *, sample=None,
+                            thresholds=None):
+    """Schedule the import of a directory, routing it to the queue of the
+    large trees if its estimated size exceeds `thresholds`.
+
+    Args:
+        sample (float): sampling of the size estimation, see
+          :func:`swh.loader.dir.scan.estimate_tree_size`
+        thresholds (dict): see :func:`swh.loader.dir.scan.is_large_tree`
+
+    Returns:
+        str: the id of the scheduled task
+
     """
+    from swh.loader.dir.scan import estimate_tree_size, is_large_tree
+
+    size_hint = estimate_tree_size(os.fsencode(dir_path), sample=sample)
+    size_hint['large'] = is_large_tree(size_hint, thresholds)
+
+    options = {}
+    if size_hint['large']:
+        options['queue'] = load_directory.name + LARGE_QUEUE_SUFFIX
+    return load_directory.apply_async(kwargs={
+        'dir_path': dir_path, 'origin': origin, 'visit_date': visit_date,
+        'revision': revision, 'release': release,
+        'branch_name': branch_name, 'size_hint': size_hint,
+    }, **options).id
+
+
+@app.task(name=__name__ + '.LoadDirRepositorySharded')
+def load_directory_sharded(dir_path, origin, visit_date, revision, release,
+                           branch_name=None, shard_depth=1):
+    """Import a directory to Software Heritage, splitting it in subtrees
+    loaded by separate tasks
+
+    The subtrees rooted shard_depth levels below dir_path are loaded in
+    parallel by :func:`load_directory_shard` tasks, then
+    :func:`assemble_directory` loads the upper levels of the tree, the
+    revision and the snapshot.
+
+    """
+    from celery import chord
+
+    from swh.loader.dir.loader import DirLoader
+    from swh.loader.dir.sharding import split_tree
+
+    loader = DirLoader()
+    origin = dict(origin)
+    if not origin.get('id'):
+        origin['id'] = loader.send_origin(origin)
+
+    shards = split_tree(os.fsencode(dir_path), shard_depth)
+    header = [load_directory_shard.s(dir_path, os.fsdecode(shard),
+                                     origin['id'])
+              for shard in shards]
+    callback = assemble_directory.s(
+        dir_path=dir_path, origin=origin, visit_date=visit_date,
+        revision=revision, release=release, branch_name=branch_name)
+    if not header:
+        return callback.delay([]).id
+    return chord(header)(callback).id
+
+
+@app.task(name=__name__ + '.LoadDirShard')
+def load_directory_shard(dir_path, shard, origin_id):
+    """Import the contents and directories of the subtree shard of dir_path
+
+    """
+    from swh.loader.dir.loader import DirLoader
+
+    return DirLoader().load_shard(dir_path=dir_path, shard=shard,
+                                  origin_id=origin_id)
+
+
+@app.task(name=__name__ + '.AssembleDirRepository')
+def assemble_directory(shards, dir_path, origin, visit_date, revision,
+                       release, branch_name=None):
+    """Import a directory whose subtrees shards were already imported
+
+    """
+    from swh.loader.dir.loader import DirLoader
+
     return DirLoader().load(dir_path=dir_path, origin=origin,
                             visit_date=visit_date, revision=revision,
-                            release=release, branch_name=branch_name)
+                            release=release, branch_name=branch_name,
+                            shards=shards)
@@ -0,0 +1,75 @@
+# Copyright (C) 2018  The Software Heritage developers
+# See the AUTHORS file at the top-level directory of this distribution
+# License: GNU General Public License version 3, or any later version
+# See top-level LICENSE file for more information
+
+import unittest
+
+from swh.loader.dir.batching import AIMDPacketSize, AdaptivePacketSizes
+
+
+class TestAIMDPacketSize(unittest.TestCase):
+    def test_update(self):
+        size = AIMDPacketSize(1000, minimum=100, maximum=1250)
+
+        self.assertEqual(size.update(1, target_latency=5), 1100)
+        self.assertEqual(size.update(1, target_latency=5), 1200)
+        self.assertEqual(size.update(1, target_latency=5), 1250)
+        self.assertEqual(size.update(10, target_latency=5), 625)
+        self.assertEqual(size.update(10, target_latency=5), 312)
+        self.assertEqual(size.update(10, target_latency=5), 156)
+        self.assertEqual(size.update(10, target_latency=5), 100)
+
+    def test_initial_size_within_bounds(self):
+        self.assertEqual(
+            AIMDPacketSize(10, minimum=100, maximum=1000).size, 100)
+        self.assertEqual(
+            AIMDPacketSize(10000, minimum=100, maximum=1000).size, 1000)
+
+
+class TestAdaptivePacketSizes(unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+        self.sizes = AdaptivePacketSizes({
+            'target_latency': 2,
+            'content_packet_size': [10, 1000],
+            'directory_packet_size': [100, 10000],
+        }, {
+            'content_packet_size': 100,
+            'content_packet_size_bytes': 1024,
+            'directory_packet_size': 1000,
+        })
+
+    def test_observe(self):
+        """Only the packet sizes of the observed type should change"""
+        self.sizes.observe('content', 3, 100, 2048)
+        self.sizes.observe('content', 1, 50, 1024)
+
+        self.assertEqual(self.sizes.get('content_packet_size', None), 60)
+        self.assertEqual(self.sizes.get('directory_packet_size', None), 1000)
+        # not adapted
+        self.assertEqual(self.sizes.get('content_packet_size_bytes', 1024),
+                         1024)
+
+        summary = self.sizes.summary()
+        self.assertEqual(summary['content_requests'], 2)
+        self.assertEqual(summary['content_objects_per_second'], 37.5)
+        self.assertEqual(summary['content_bytes_per_second'], 768)
+        self.assertEqual(summary['directory_requests'], 0)
+        self.assertEqual(summary['directory_objects_per_second'], 0)
+
+    def test_observe_failure(self):
+        """Failed requests should reduce the packet sizes down to their
+        minimum"""
+        self.assertTrue(self.sizes.observe_failure('content'))
+        self.assertEqual(self.sizes.get('content_packet_size', None), 50)
+
+        for _ in range(3):
+            self.assertTrue(self.sizes.observe_failure('content'))
+        self.assertFalse(self.sizes.observe_failure('content'))
+        self.assertEqual(self.sizes.get('content_packet_size', None), 10)
+        self.assertEqual(self.sizes.get('directory_packet_size', None), 1000)
+
+        summary = self.sizes.summary()
+        self.assertEqual(summary['content_failures'], 5)
+        self.assertEqual(summary['content_requests'], 0)
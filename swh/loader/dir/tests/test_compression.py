@@ -0,0 +1,112 @@
+# Copyright (C) 2018  The Software Heritage developers
+# See the AUTHORS file at the top-level directory of this distribution
+# License: GNU General Public License version 3, or any later version
+# See top-level LICENSE file for more information
+
+import gzip
+import unittest
+
+from io import BytesIO
+
+from swh.core.serializers import msgpack_loads
+from swh.loader.dir.compression import (CompressedRemoteStorage,
+                                        EncodedPacket, GzipRequestMiddleware)
+
+
+def content(data):
+    return {'sha1': b'\x00' * 20, 'length': len(data), 'data': data}
+
+
+class TestCompressedRemoteStorage(unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+        self.storage = CompressedRemoteStorage('http://localhost:5002/',
+                                               threshold=1024)
+
+    def test_encode_content_add_small(self):
+        """Small packets should not be compressed"""
+        packet = [content(b'foo')]
+
+        data, headers = self.storage.encode_content_add(packet)
+
+        self.assertNotIn('content-encoding', headers)
+        self.assertEqual(msgpack_loads(data), {'content': packet})
+
+    def test_encode_content_add(self):
+        packet = [content(b'foo\n' * 1024)]
+
+        data, headers = self.storage.encode_content_add(packet)
+
+        self.assertEqual(headers['content-encoding'], 'gzip')
+        self.assertLess(len(data), 1024)
+        self.assertEqual(msgpack_loads(gzip.decompress(data)),
+                         {'content': packet})
+
+    def test_prefetch(self):
+        """Packets should be encoded in the background, and kept in order"""
+        packets = [[content(b'%d' % i)] for i in range(5)]
+
+        encoded = list(self.storage.prefetch(iter(packets)))
+
+        self.assertEqual(encoded, packets)
+        for packet in encoded:
+            self.assertIsInstance(packet, EncodedPacket)
+            self.assertEqual(packet.encoded.result(),
+                             self.storage.encode_content_add(packet))
+
+    def test_content_add(self):
+        """Encoded packets should not be encoded again"""
+        sent = []
+        self.storage.raw_post = lambda endpoint, data, **opts: sent.append(
+            (endpoint, data, opts['headers']))
+        self.storage._decode_response = lambda response: None
+        packet = next(self.storage.prefetch([[content(b'foo\n' * 1024)]]))
+
+        self.storage.content_add(packet)
+
+        self.assertEqual(sent, [('content/add',) + packet.encoded.result()])
+
+    def test_close(self):
+        """Closing should stop the compression threads until the next
+        prefetch"""
+        packets = [[content(b'foo')]]
+        list(self.storage.prefetch(packets))
+        executor = self.storage.executor
+
+        self.storage.close()
+
+        self.assertIsNone(self.storage.executor)
+        with self.assertRaises(RuntimeError):
+            executor.submit(len, b'')
+        self.assertEqual(list(self.storage.prefetch(packets)), packets)
+        self.storage.close()
+
+
+class TestGzipRequestMiddleware(unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+
+        def app(environ, start_response):
+            length = int(environ['CONTENT_LENGTH'])
+            return [environ['wsgi.input'].read(length)]
+
+        self.app = GzipRequestMiddleware(app)
+
+    def test_gzip(self):
+        data = gzip.compress(b'some data')
+        environ = {
+            'HTTP_CONTENT_ENCODING': 'gzip',
+            'CONTENT_LENGTH': str(len(data)),
+            'wsgi.input': BytesIO(data),
+        }
+
+        self.assertEqual(self.app(environ, None), [b'some data'])
+        self.assertNotIn('HTTP_CONTENT_ENCODING', environ)
+
+    def test_identity(self):
+        environ = {
+            'CONTENT_LENGTH': '9',
+            'wsgi.input': BytesIO(b'some data'),
+        }
+
+        self.assertEqual(self.app(environ, None), [b'some data'])
@@ -0,0 +1,140 @@
+# Copyright (C) 2018  The Software Heritage developers
+# See the AUTHORS file at the top-level directory of this distribution
+# License: GNU General Public License version 3, or any later version
+# See top-level LICENSE file for more information
+
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+import pytest
+
+from swh.loader.dir.git import GitIndex
+from swh.loader.dir.walker import DirectoryWalker
+from swh.model.from_disk import Directory
+from swh.storage.in_memory import Storage
+
+
+def git(path, *args):
+    subprocess.check_output(['git', '-c', 'user.name=swh',
+                             '-c', 'user.email=swh@example.org'] +
+                            list(args), cwd=path)
+
+
+@pytest.mark.fs
+class TestGitIndex(unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+        self.path = tempfile.mkdtemp(prefix='swh.loader.dir.',
+                                     suffix='-tests').encode()
+        os.makedirs(os.path.join(self.path, b'foo'))
+        for name, data in [(b'README', b'read me\n'),
+                           (b'foo/quotes.md', b'some quotes\n'),
+                           (b'foo/dirty', b'clean for now\n')]:
+            with open(os.path.join(self.path, name), 'wb') as f:
+                f.write(data)
+        os.symlink(b'foo/quotes.md', os.path.join(self.path, b'link'))
+
+        git(self.path, 'init', '-q')
+        git(self.path, 'add', '.')
+        git(self.path, 'commit', '-q', '-m', 'initial')
+
+        with open(os.path.join(self.path, b'foo/dirty'), 'ab') as f:
+            f.write(b'not anymore\n')
+        with open(os.path.join(self.path, b'untracked'), 'wb') as f:
+            f.write(b'untracked\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+        super().tearDown()
+
+    def test_from_path(self):
+        """Only the clean tracked files should be indexed"""
+        index = GitIndex.from_path(self.path)
+
+        self.assertEqual(set(index.blobs),
+                         {b'README', b'foo/quotes.md', b'link'})
+
+    def test_from_path_unchecked_files(self):
+        """Files git is told not to check should not be indexed"""
+        git(self.path, 'update-index', '--assume-unchanged', 'foo/dirty')
+        git(self.path, 'update-index', '--skip-worktree', 'foo/quotes.md')
+        with open(os.path.join(self.path, b'foo/quotes.md'), 'ab') as f:
+            f.write(b'hidden from git status\n')
+
+        index = GitIndex.from_path(self.path)
+
+        self.assertEqual(set(index.blobs), {b'README', b'link'})
+
+    def test_sha1_git_size(self):
+        """Files whose size differs from the index should not be used"""
+        index = GitIndex.from_path(self.path)
+        readme = os.path.join(self.path, b'README')
+        file_stat = os.lstat(readme)
+        resized = os.stat_result((file_stat.st_mode, 0, 0, 1, 0, 0,
+                                  file_stat.st_size + 1, 0, 0, 0))
+
+        self.assertIsNotNone(index.sha1_git(b'README', file_stat))
+        self.assertIsNone(index.sha1_git(b'README', resized))
+
+    def test_from_path_not_a_work_tree(self):
+        """Directories outside of the root of a work tree are not indexed"""
+        self.assertIsNone(GitIndex.from_path(os.path.join(self.path, b'foo')))
+
+    def test_walk(self):
+        """Walking with the index should not change any id"""
+        storage = Storage()
+        expected = Directory.from_disk(path=self.path)
+        storage.content_add([{
+            'sha1': b'\x00' * 20,
+            'sha1_git': expected[b'README'].hash,
+            'sha256': b'\x00' * 32,
+            'blake2s256': b'\x00' * 32,
+            'length': 8,
+            'data': b'read me\n',
+            'status': 'visible',
+        }])
+
+        walker = DirectoryWalker(git_index=GitIndex.from_path(self.path))
+        directory = walker.walk(self.path)
+        walker.complete_contents(storage)
+
+        self.assertEqual(walker.counters['git'], 3)
+        self.assertEqual(directory.hash, expected.hash)
+        self.assertTrue(directory[b'README'].collected)
+        self.assertEqual(directory[b'foo/quotes.md'].data,
+                         expected[b'foo/quotes.md'].data)
+        self.assertEqual(directory[b'link'].data, expected[b'link'].data)
+
+    def convert_end_of_lines(self):
+        """Commit a text file checked out with CRLF end of lines"""
+        with open(os.path.join(self.path, b'.gitattributes'), 'wb') as f:
+            f.write(b'*.txt text eol=crlf\n')
+        with open(os.path.join(self.path, b'notes.txt'), 'wb') as f:
+            f.write(b'some\nnotes\n')
+        git(self.path, 'add', '.gitattributes', 'notes.txt')
+        git(self.path, 'commit', '-q', '-m', 'notes')
+        os.unlink(os.path.join(self.path, b'notes.txt'))
+        git(self.path, 'checkout', 'notes.txt')
+
+    def test_from_path_converted_files(self):
+        """Files converted by git should not be indexed"""
+        self.convert_end_of_lines()
+        with open(os.path.join(self.path, b'notes.txt'), 'rb') as f:
+            self.assertEqual(f.read(), b'some\r\nnotes\r\n')
+        expected = Directory.from_disk(path=self.path)
+
+        index = GitIndex.from_path(self.path)
+        directory = DirectoryWalker(git_index=index).walk(self.path)
+
+        self.assertIn(b'README', index.blobs)
+        self.assertNotIn(b'notes.txt', index.blobs)
+        self.assertEqual(directory.hash, expected.hash)
+
+    def test_from_path_autocrlf(self):
+        """Work trees converting end of lines should not be indexed"""
+        git(self.path, 'config', 'core.autocrlf', 'input')
+
+        self.assertIsNone(GitIndex.from_path(self.path))
@@ -3,13 +3,31 @@
 # License: GNU General Public License version 3, or any later version
 # See top-level LICENSE file for more information
 
+import math
 import os
 import pytest
+import time
+import unittest
+
+from unittest.mock import Mock
 
 from swh.loader.core.tests import BaseLoaderTest
 from swh.loader.dir.loader import DirLoader
+from swh.loader.dir.walker import RACY_DELAY
 
 from swh.model import hashutil
+from swh.model.from_disk import Directory
+from swh.storage.exc import StorageAPIError
+
+
+def wait_racy_delay():
+    """Wait until the files written so far are older than any listing
+    started afterwards, by more than the racy delay (see
+    :func:`swh.loader.dir.walker.changed_since`).
+
+    """
+    now = time.time()
+    time.sleep(math.floor(now) + RACY_DELAY + 1 - now)
 
 
 @pytest.mark.fs
@@ -26,9 +44,16 @@ class DirLoaderNoStorage(DirLoader):
     Context:
         Load a tarball with a persistent-less tarball loader
 
+    Args:
+        config: overrides of the default test configuration
+
     """
+    def __init__(self, **config):
+        self.config_overrides = config
+        super().__init__()
+
     def parse_config_file(self, *args, **kwargs):
-        return {
+        config = {
             'storage': {
                 'cls': 'memory',
                 'args': {
@@ -46,8 +71,18 @@ class DirLoaderNoStorage(DirLoader):
             'content_packet_block_size_bytes': 104857600,
             'send_snapshot': True,
             'release_packet_size': 100000,
-            'send_releases': True
+            'send_releases': True,
+            'incremental': False,
+            'git_index': False,
+            'deferred_hashes': False,
+            'read_scheduler': {},
+            'large_tree': {},
+            'adaptive_packets': {},
+            'content_compression': {},
+            'spool': '',
         }
+        config.update(getattr(self, 'config_overrides', {}))
+        return config
 
 
 class DirLoaderListRepoObject(BaseDirLoaderTest):
@@ -196,3 +231,293 @@ class SWHDirLoaderITTest(BaseDirLoaderTest):
 
         self.assertCountReleases(0)
         self.assertCountSnapshots(1)
+
+    def test_load_explicit_config(self):
+        """A configuration without the optional settings should load"""
+        # given
+        config = {key: value for key, value in self.loader.config.items()
+                  if key not in DirLoader.ADDITIONAL_CONFIG
+                  or key == 'content_size_limit'}  # used by the core loader
+        loader = DirLoader(config=config)
+        self.storage = loader.storage
+
+        # when
+        loader.load(
+            dir_path=self.destination_path,
+            origin={'url': 'file:///tmp/sample-folder', 'type': 'dir'},
+            visit_date='Tue, 3 May 2016 17:16:32 +0200',
+            revision=SYNTHETIC_REVISION, release=None)
+
+        # then
+        self.assertCountContents(8)
+        self.assertCountDirectories(6)
+
+    def test_load_shard_cleanup(self):
+        """Loading a shard should clean up after itself, even on failure"""
+        shard = sorted(os.listdir(self.destination_path))[0]
+        self.loader.cleanup = Mock()
+
+        self.loader.load_shard(dir_path=self.destination_path, shard=shard,
+                               origin_id=1)
+        self.assertEqual(self.loader.cleanup.call_count, 1)
+
+        self.loader.send_batch_contents = Mock(side_effect=OSError)
+        with self.assertRaises(OSError):
+            self.loader.load_shard(dir_path=self.destination_path,
+                                   shard=shard, origin_id=1)
+        self.assertEqual(self.loader.cleanup.call_count, 2)
+
+
+SWH_PERSON = {
+    'name': 'Software Heritage',
+    'fullname': 'Software Heritage',
+    'email': 'robot@softwareheritage.org'
+}
+
+SYNTHETIC_REVISION = {
+    'date': {
+        'timestamp': 1544013323,
+        'offset': 0,
+    },
+    'committer_date': {
+        'timestamp': 1544013323,
+        'offset': 0,
+    },
+    'author': SWH_PERSON,
+    'committer': SWH_PERSON,
+    'type': 'tar',
+    'message': 'swh-loader-dir: synthetic revision message',
+    'metadata': {},
+    'synthetic': True,
+}
+
+
+class SWHIncrementalDirLoaderITTest(BaseDirLoaderTest):
+    def setUp(self):
+        super().setUp()
+        self.loader = DirLoaderNoStorage(incremental=True)
+        self.storage = self.loader.storage
+        # the extracted files must predate the first listing to be reused
+        wait_racy_delay()
+
+        self.origin = {
+            'url': 'file:///tmp/sample-folder',
+            'type': 'dir'
+        }
+        self.revision = SYNTHETIC_REVISION
+
+    def load(self, visit_date):
+        self.loader.load(
+            dir_path=self.destination_path, origin=self.origin,
+            visit_date=visit_date, revision=self.revision,
+            release=None, branch_name='master')
+        return list(self.loader.objects['revision'])[0]
+
+    def test_load_incremental(self):
+        """Reloading an unchanged directory should reuse the archived tree
+
+        """
+        # given
+        rev_id = self.load('Tue, 3 May 2016 17:16:32 +0200')
+
+        # when
+        new_rev_id = self.load('Wed, 4 May 2016 17:16:32 +0200')
+
+        # then
+        self.assertCountContents(8)
+        self.assertCountDirectories(6)
+        self.assertCountRevisions(2)
+        self.assertCountSnapshots(2)
+
+        new_revision = next(self.storage.revision_get([new_rev_id]))
+        self.assertEqual(new_revision['parents'], [rev_id])
+        self.assertEqual(self.loader.objects['content'], {})
+        self.assertEqual(self.loader.objects['directory'], {})
+
+    def test_load_incremental_modified_file(self):
+        """Modified files should be hashed and sent again
+
+        """
+        # given
+        self.load('Tue, 3 May 2016 17:16:32 +0200')
+        with open(os.path.join(self.destination_path, 'sample-folder',
+                               'foo', 'quotes.md'), 'ab') as f:
+            f.write(b'one more quote\n')
+
+        # when
+        self.load('Wed, 4 May 2016 17:16:32 +0200')
+
+        # then
+        self.assertCountContents(9)
+        self.assertEqual(len(self.loader.objects['content']), 1)
+        # the root, sample-folder/ and foo/ changed, not bar/
+        self.assertEqual(len(self.loader.objects['directory']), 3)
+
+    def test_load_incremental_reset_mtime(self):
+        """Files rewritten with their previous size and mtime should be
+        hashed again
+
+        """
+        # given
+        self.load('Tue, 3 May 2016 17:16:32 +0200')
+        path = os.path.join(self.destination_path, 'sample-folder', 'foo',
+                            'quotes.md')
+        file_stat = os.stat(path)
+        with open(path, 'r+b') as f:
+            data = f.read()
+            f.seek(0)
+            f.write(data.swapcase())
+        os.utime(path, ns=(file_stat.st_atime_ns, file_stat.st_mtime_ns))
+
+        # when
+        rev_id = self.load('Wed, 4 May 2016 17:16:32 +0200')
+
+        # then
+        self.assertEqual(len(self.loader.objects['content']), 1)
+        revision = next(self.storage.revision_get([rev_id]))
+        self.assertEqual(
+            revision['directory'],
+            Directory.from_disk(
+                path=self.destination_path.encode()).hash)
+
+
+class SWHDeferredDirLoaderITTest(BaseDirLoaderTest):
+    def setUp(self):
+        super().setUp()
+        self.loader = DirLoaderNoStorage(deferred_hashes=True)
+        self.storage = self.loader.storage
+
+    def load(self, visit_date):
+        self.loader.load(
+            dir_path=self.destination_path,
+            origin={'url': 'file:///tmp/sample-folder', 'type': 'dir'},
+            visit_date=visit_date, revision=SYNTHETIC_REVISION,
+            release=None, branch_name='master')
+        return list(self.loader.objects['revision'])[0]
+
+    def test_load_deferred_hashes(self):
+        """Missing contents should be fully hashed, archived ones not
+
+        """
+        # when
+        rev_id = self.load('Tue, 3 May 2016 17:16:32 +0200')
+
+        # then
+        self.assertCountContents(8)
+        self.assertCountDirectories(6)
+        for content in self.loader.objects['content'].values():
+            self.assertEqual(
+                set(content) - {'data', 'path', 'perms'},
+                {'sha1', 'sha1_git', 'sha256', 'blake2s256', 'length'})
+
+        # when
+        new_rev_id = self.load('Wed, 4 May 2016 17:16:32 +0200')
+
+        # then
+        self.assertEqual(new_rev_id, rev_id)
+        self.assertCountContents(8)
+        self.assertEqual(self.loader.objects['content'], {})
+
+
+class TestConfigureForSize(unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+        self.loader = DirLoaderNoStorage(large_tree={
+            'read_scheduler': {'readers': 8},
+            'content_packet_size_bytes': 4294967296,
+        })
+
+    def test_configure_for_size(self):
+        """Small trees should use the default settings"""
+        self.loader.configure_for_size({'files': 10, 'large': False})
+
+        self.assertIsNone(self.loader.read_scheduler)
+        self.assertEqual(self.loader.contents.max_size, 1073741824)
+
+    def test_configure_for_size_large(self):
+        """Large trees should use the large_tree settings"""
+        self.loader.configure_for_size({'files': 10 ** 6, 'large': True})
+
+        self.assertEqual(self.loader.read_scheduler.readers, 8)
+        self.assertEqual(self.loader.contents.max_size, 4294967296)
+
+
+class SWHAdaptiveDirLoaderITTest(BaseDirLoaderTest):
+    def setUp(self):
+        super().setUp()
+        self.loader = DirLoaderNoStorage(
+            content_packet_size=2,
+            adaptive_packets={
+                'target_latency': 60,
+                'content_packet_size': [1, 4],
+            })
+        self.storage = self.loader.storage
+
+    def test_load_adaptive_packets(self):
+        """Packets should grow as the storage answers quickly
+
+        """
+        # given
+        sent = []
+        send_contents = self.loader.send_contents
+
+        def record_send_contents(content_list):
+            sent.append(len(content_list))
+            return send_contents(content_list)
+
+        self.loader.send_contents = record_send_contents
+
+        # when
+        self.loader.load(
+            dir_path=self.destination_path,
+            origin={'url': 'file:///tmp/sample-folder', 'type': 'dir'},
+            visit_date='Tue, 3 May 2016 17:16:32 +0200',
+            revision=SYNTHETIC_REVISION, release=None)
+
+        # then
+        self.assertCountContents(8)
+        self.assertEqual(sent, [2, 3, 3])
+        self.assertEqual(
+            self.loader.get_packet_size('content_packet_size'), 4)
+
+    def test_load_adaptive_packets_failure(self):
+        """Packets failing to be sent should be split at the reduced size
+
+        """
+        # given
+        sent = []
+        content_add = self.storage.content_add
+
+        def failing_content_add(content):
+            sent.append(len(content))
+            if len(sent) == 1:
+                raise StorageAPIError('timed out')
+            return content_add(content)
+
+        self.storage.content_add = failing_content_add
+
+        # when
+        self.loader.load(
+            dir_path=self.destination_path,
+            origin={'url': 'file:///tmp/sample-folder', 'type': 'dir'},
+            visit_date='Tue, 3 May 2016 17:16:32 +0200',
+            revision=SYNTHETIC_REVISION, release=None)
+
+        # then
+        self.assertCountContents(8)
+        self.assertEqual(sent[:3], [2, 1, 1])
+        self.assertEqual(
+            self.loader.packet_sizes.summary()['content_failures'], 1)
+
+    def test_load_adaptive_packets_failure_minimum(self):
+        """Failures at the minimum packet size should not be retried"""
+        # given
+        def failing_content_add(content):
+            raise StorageAPIError('timed out')
+
+        self.storage.content_add = failing_content_add
+        self.loader.packet_sizes.sizes['content_packet_size'].size = 1
+
+        # when
+        with self.assertRaises(StorageAPIError):
+            self.loader.send_contents([{'length': 1}])
@@ -0,0 +1,242 @@
+# Copyright (C) 2018  The Software Heritage developers
+# See the AUTHORS file at the top-level directory of this distribution
+# License: GNU General Public License version 3, or any later version
+# See top-level LICENSE file for more information
+
+import os
+import shutil
+import tempfile
+
+from unittest.mock import patch
+
+from swh.loader.dir.manifest import (Manifest, diff_ids, diff_manifests,
+                                     write_manifest)
+from swh.loader.dir.tests.test_loader import (BaseDirLoaderTest,
+                                              DirLoaderNoStorage,
+                                              SYNTHETIC_REVISION,
+                                              wait_racy_delay)
+from swh.loader.dir import walker
+from swh.loader.dir.walker import DirectoryWalker
+
+
+class TestManifest(BaseDirLoaderTest):
+    def setUp(self):
+        super().setUp()
+        self.path = self.destination_path.encode()
+        self.manifest_dir = tempfile.mkdtemp(prefix='swh.loader.dir.',
+                                             suffix='-manifest')
+        self.manifest_path = os.path.join(self.manifest_dir, 'manifest')
+
+    def tearDown(self):
+        shutil.rmtree(self.manifest_dir)
+        super().tearDown()
+
+    def walk(self):
+        directory = DirectoryWalker(save_path=True).walk(self.path)
+        write_manifest(self.manifest_path, directory)
+        return directory
+
+    def test_write_manifest(self):
+        directory = self.walk()
+        objects = directory.collect()
+
+        with Manifest(self.manifest_path) as manifest:
+            self.assertEqual(manifest.root_id, directory.hash)
+            self.assertEqual(list(manifest.content_ids()),
+                             sorted(objects['content']))
+            self.assertEqual(list(manifest.directory_ids()),
+                             sorted(objects['directory']))
+            for sha1_git, content in objects['content'].items():
+                self.assertEqual(
+                    manifest.find_content(sha1_git),
+                    {key: content[key] for key in ['sha1', 'sha1_git',
+                                                   'sha256', 'blake2s256',
+                                                   'length']})
+            for dir_id, expected in objects['directory'].items():
+                self.assertEqual(manifest.find_directory(dir_id), expected)
+            self.assertIsNone(manifest.find_content(b'\x00' * 20))
+            self.assertEqual(
+                {path for path, _ in manifest.paths()},
+                {os.path.relpath(os.path.join(root, name), self.path)
+                 for root, dentries, fentries in os.walk(self.path)
+                 for name in dentries + fentries})
+
+    def test_to_directory(self):
+        """The tree rebuilt from a manifest should match the walked one"""
+        expected = self.walk()
+
+        with Manifest(self.manifest_path) as manifest:
+            directory, partial_contents = manifest.to_directory(self.path)
+
+        self.assertEqual(directory.hash, expected.hash)
+        self.assertEqual(partial_contents, [])
+        self.assertEqual(directory.collect(), expected.collect())
+
+    def test_to_directory_same_blob(self):
+        """Entries sharing a blob should keep their own kind and perms"""
+        same = os.path.join(self.path, b'same')
+        os.mkdir(same)
+        for name, mode in [(b'plain', 0o644), (b'exec', 0o755)]:
+            with open(os.path.join(same, name), 'wb') as f:
+                f.write(b'x')
+            os.chmod(os.path.join(same, name), mode)
+        os.symlink(b'x', os.path.join(same, b'link'))
+        expected = self.walk()
+
+        with Manifest(self.manifest_path) as manifest:
+            directory, _ = manifest.to_directory(self.path)
+
+        self.assertEqual(directory.hash, expected.hash)
+        for name in [b'plain', b'exec', b'link']:
+            entry = directory[b'same/' + name]
+            self.assertEqual(entry.data['perms'],
+                             expected[b'same/' + name].data['perms'])
+        self.assertEqual(directory[b'same/link'].data['data'], b'x')
+        self.assertNotIn('data', directory[b'same/plain'].data)
+
+    def test_list_objs(self):
+        """Listing from a saved manifest should give the same objects"""
+        loader = DirLoaderNoStorage()
+        kwargs = {
+            'dir_path': self.path, 'revision': SYNTHETIC_REVISION,
+            'release': None, 'branch_name': 'master',
+        }
+        expected = loader.list_objs(save_manifest=self.manifest_path,
+                                    **kwargs)
+        self.assertFalse(os.path.exists(self.manifest_path))
+        loader.write_pending_manifest()
+
+        objects = loader.list_objs(manifest=self.manifest_path, **kwargs)
+
+        self.assertEqual(objects, expected)
+
+    def test_diff_manifests(self):
+        """Diffs should only show the changed objects"""
+        self.walk()
+        old_path = self.manifest_path + '.old'
+        os.rename(self.manifest_path, old_path)
+        with open(os.path.join(self.path, b'sample-folder', b'foo',
+                               b'quotes.md'), 'ab') as f:
+            f.write(b'one more quote\n')
+        self.walk()
+
+        with Manifest(old_path) as old, \
+                Manifest(self.manifest_path) as new:
+            diff = diff_manifests(old, new)
+
+        self.assertEqual(len(diff['content']['added']), 1)
+        self.assertEqual(len(diff['content']['removed']), 1)
+        # the root, sample-folder/ and foo/
+        self.assertEqual(len(diff['directory']['added']), 3)
+        self.assertEqual(len(diff['directory']['removed']), 3)
+
+    def test_diff_ids(self):
+        self.assertEqual(diff_ids([b'a', b'c', b'd'], [b'b', b'c', b'e']),
+                         ([b'b', b'e'], [b'a', b'd']))
+        self.assertEqual(diff_ids([], [b'a']), ([b'a'], []))
+
+
+class TestManifestDiffLoading(BaseDirLoaderTest):
+    def setUp(self):
+        super().setUp()
+        self.loader = DirLoaderNoStorage()
+        self.storage = self.loader.storage
+        self.work_dir = tempfile.mkdtemp(prefix='swh.loader.dir.',
+                                         suffix='-diff')
+        self.manifest_path = os.path.join(self.work_dir, 'manifest')
+
+        # the next version of the tree, with one modified file
+        self.new_path = os.path.join(self.work_dir, 'new')
+        shutil.copytree(self.destination_path, self.new_path, symlinks=True)
+        with open(os.path.join(self.new_path, 'sample-folder', 'foo',
+                               'quotes.md'), 'ab') as f:
+            f.write(b'one more quote\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+        super().tearDown()
+
+    def load(self, dir_path, visit_date, **kwargs):
+        with patch.object(walker, 'hash_regular_file',
+                          wraps=walker.hash_regular_file) as hash_file:
+            self.loader.load(
+                dir_path=dir_path,
+                origin={'url': 'file:///tmp/sample-folder', 'type': 'dir'},
+                visit_date=visit_date, revision=SYNTHETIC_REVISION,
+                release=None, branch_name='master', **kwargs)
+        self.hashed = hash_file.call_count
+        return list(self.loader.objects['revision'])[0]
+
+    def assertOnlyDiffLoaded(self, rev_id, new_rev_id):
+        self.assertEqual(self.hashed, 1)
+        self.assertCountContents(9)
+        self.assertEqual(len(self.loader.objects['content']), 1)
+        # the root, sample-folder/ and foo/ changed, not bar/
+        self.assertEqual(len(self.loader.objects['directory']), 3)
+        self.assertCountRevisions(2)
+
+        new_revision = next(self.storage.revision_get([new_rev_id]))
+        self.assertEqual(new_revision['parents'], [rev_id])
+
+    def test_load_with_previous_manifest(self):
+        """Only the files changed since the manifest should be hashed"""
+        # the extracted files must predate the first listing to be reused
+        wait_racy_delay()
+        rev_id = self.load(self.destination_path,
+                           'Tue, 3 May 2016 17:16:32 +0200',
+                           save_manifest=self.manifest_path)
+
+        new_rev_id = self.load(self.new_path,
+                               'Wed, 4 May 2016 17:16:32 +0200',
+                               previous_path=self.destination_path,
+                               previous_manifest=self.manifest_path,
+                               save_manifest=self.manifest_path)
+
+        self.assertOnlyDiffLoaded(rev_id, new_rev_id)
+        with Manifest(self.manifest_path) as manifest:
+            self.assertEqual(manifest.revision_id, new_rev_id)
+
+    def test_load_failed(self):
+        """The manifest of a failed load should not be saved"""
+        with patch.object(self.storage, 'content_add',
+                          side_effect=ValueError('storage failure')):
+            try:
+                self.load(self.destination_path,
+                          'Tue, 3 May 2016 17:16:32 +0200',
+                          save_manifest=self.manifest_path)
+            except ValueError:
+                pass
+        self.assertCountContents(0)
+        self.assertFalse(os.path.exists(self.manifest_path))
+
+        # as in the tasks, a new loader (which has not seen any content)
+        self.loader = DirLoaderNoStorage()
+        self.loader.storage = self.storage
+        new_rev_id = self.load(self.new_path,
+                               'Wed, 4 May 2016 17:16:32 +0200',
+                               previous_path=self.destination_path,
+                               previous_manifest=self.manifest_path,
+                               save_manifest=self.manifest_path)
+
+        # nothing reused
+        self.assertEqual(self.hashed, sum(
+            os.path.isfile(os.path.join(root, name))
+            and not os.path.islink(os.path.join(root, name))
+            for root, _, names in os.walk(self.new_path) for name in names))
+        self.assertCountContents(8)
+        self.assertEqual(len(self.loader.objects['directory']), 6)
+        with Manifest(self.manifest_path) as manifest:
+            self.assertEqual(manifest.revision_id, new_rev_id)
+
+    def test_load_with_previous_path(self):
+        """Without manifest, the hashes should come from the archive"""
+        # the extracted files must predate the first listing to be reused
+        wait_racy_delay()
+        rev_id = self.load(self.destination_path,
+                           'Tue, 3 May 2016 17:16:32 +0200')
+
+        new_rev_id = self.load(self.new_path,
+                               'Wed, 4 May 2016 17:16:32 +0200',
+                               previous_path=self.destination_path)
+
+        self.assertOnlyDiffLoaded(rev_id, new_rev_id)
@@ -0,0 +1,68 @@
+# Copyright (C) 2018  The Software Heritage developers
+# See the AUTHORS file at the top-level directory of this distribution
+# License: GNU General Public License version 3, or any later version
+# See top-level LICENSE file for more information
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from unittest.mock import patch
+
+import pytest
+
+from swh.loader.dir import readahead
+from swh.loader.dir.readahead import ReadScheduler
+from swh.model.hashutil import MultiHash
+
+
+@pytest.mark.fs
+class TestReadScheduler(unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+        self.path = tempfile.mkdtemp(prefix='swh.loader.dir.',
+                                     suffix='-tests').encode()
+        self.files = []
+        for i in range(10):
+            path = os.path.join(self.path, b'file-%d' % i)
+            with open(path, 'wb') as f:
+                f.write(b'%d\n' % i)
+            self.files.append((path, os.lstat(path)))
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+        super().tearDown()
+
+    def test_hash_files(self):
+        """The hashes should be returned in the order of the files"""
+        scheduler = ReadScheduler(readahead=3, readers=2)
+
+        hashes = scheduler.hash_files(list(reversed(self.files)),
+                                      hash_names={'sha1_git'})
+
+        self.assertEqual(hashes, [
+            MultiHash.from_path(path, hash_names={'sha1_git'}).digest()
+            for path, _ in reversed(self.files)
+        ])
+
+    def test_hash_files_inode_order(self):
+        """The files should be read ahead in inode order"""
+        advised = []
+        scheduler = ReadScheduler(readahead=3)
+
+        with patch.object(readahead, 'advise_willneed', advised.append):
+            scheduler.hash_files(list(reversed(self.files)))
+
+        self.assertEqual(advised, [
+            path for path, _ in sorted(self.files,
+                                       key=lambda f: f[1].st_ino)
+        ])
+
+    def test_hash_files_not_regular(self):
+        """Files replaced by FIFOs should not be read"""
+        path = os.path.join(self.path, b'fifo')
+        os.mkfifo(path)
+
+        with self.assertRaises(ValueError):
+            ReadScheduler().hash_files([(path, os.lstat(path))])
@@ -0,0 +1,54 @@
+# Copyright (C) 2018  The Software Heritage developers
+# See the AUTHORS file at the top-level directory of this distribution
+# License: GNU General Public License version 3, or any later version
+# See top-level LICENSE file for more information
+
+import os
+import unittest
+
+from swh.loader.dir.scan import estimate_tree_size, is_large_tree
+from swh.loader.dir.tests.test_loader import BaseDirLoaderTest
+
+
+class TestEstimateTreeSize(BaseDirLoaderTest):
+    def setUp(self):
+        super().setUp()
+        self.path = self.destination_path.encode()
+
+    def test_estimate_tree_size(self):
+        size = 0
+        for root, dentries, fentries in os.walk(self.path):
+            for name in fentries + [name for name in dentries
+                                    if os.path.islink(os.path.join(root,
+                                                                   name))]:
+                size += os.lstat(os.path.join(root, name)).st_size
+
+        self.assertEqual(estimate_tree_size(self.path), {
+            'files': 8,
+            'directories': 5,
+            'bytes': size,
+            'sampled': False,
+        })
+
+    def test_estimate_tree_size_sampled(self):
+        """Sampling should only scan part of the tree, and scale it up"""
+        full = estimate_tree_size(self.path)
+
+        self.assertEqual(estimate_tree_size(self.path, sample=1.0),
+                         dict(full, sampled=True))
+        # only the root is scanned
+        self.assertEqual(estimate_tree_size(self.path, sample=0.0), {
+            'files': 0,
+            'directories': 1,
+            'bytes': 0,
+            'sampled': True,
+        })
+
+
+class TestIsLargeTree(unittest.TestCase):
+    def test_is_large_tree(self):
+        size = {'files': 10, 'directories': 2, 'bytes': 1024}
+
+        self.assertFalse(is_large_tree(size))
+        self.assertTrue(is_large_tree(size, {'files': 9}))
+        self.assertTrue(is_large_tree(size, {'files': 10, 'bytes': 1000}))
@@ -0,0 +1,131 @@
+# Copyright (C) 2018  The Software Heritage developers
+# See the AUTHORS file at the top-level directory of this distribution
+# License: GNU General Public License version 3, or any later version
+# See top-level LICENSE file for more information
+
+import os
+import shutil
+import tempfile
+
+from swh.loader.dir.spool import (INDEX_ENTRY, Spool, SpoolStorage,
+                                  list_spools, replay)
+from swh.loader.dir.tests.test_loader import (BaseDirLoaderTest,
+                                              DirLoaderNoStorage,
+                                              SYNTHETIC_REVISION)
+from swh.storage.in_memory import Storage
+
+
+class TestSpool(BaseDirLoaderTest):
+    def setUp(self):
+        super().setUp()
+        self.spool_path = tempfile.mkdtemp(prefix='swh.loader.dir.',
+                                           suffix='-spool')
+        self.loader = DirLoaderNoStorage(spool=self.spool_path)
+
+    def tearDown(self):
+        shutil.rmtree(self.spool_path)
+        super().tearDown()
+
+    def load(self, visit_date='Tue, 3 May 2016 17:16:32 +0200'):
+        return self.loader.load(
+            dir_path=self.destination_path,
+            origin={'url': 'file:///tmp/sample-folder', 'type': 'dir'},
+            visit_date=visit_date,
+            revision=SYNTHETIC_REVISION, release=None,
+            branch_name='master')
+
+    def test_spool(self):
+        """The spool should hold the objects of the visit"""
+        # when
+        self.assertEqual(self.load(), {'status': 'eventful'})
+
+        # then
+        self.assertIsInstance(self.loader.storage, SpoolStorage)
+        self.assertIsNone(self.loader.storage.pack)
+        spool = Spool(self.loader.storage.prefix)
+        counts = {}
+        for record_type, _, _ in spool.entries():
+            counts[record_type] = counts.get(record_type, 0) + 1
+        self.assertEqual(counts, {
+            'origin': 1,
+            'origin_visit': 1,
+            'content': 8,
+            'directory': 6,
+            'revision': 1,
+            'snapshot': 1,
+            'origin_visit_update': 1,
+        })
+        self.assertEqual(
+            [update['status']
+             for update in spool.objects('origin_visit_update')],
+            ['full'])
+
+    def test_replay(self):
+        """Replaying the spools should store the objects of the visits"""
+        # given
+        self.load()
+        self.load('Wed, 4 May 2016 17:16:32 +0200')
+        self.assertEqual(len(list_spools(self.spool_path)), 1)
+        other_spool = DirLoaderNoStorage(spool=self.spool_path)
+        other_spool.storage.content_add(
+            list(Spool(self.loader.storage.prefix).objects('content'))[:1])
+        storage = Storage()
+
+        # when
+        counters = replay(storage, list_spools(self.spool_path),
+                          batch_size=3)
+
+        # then
+        self.assertEqual(counters['content'], 9)
+        self.assertEqual(counters['origin_visit'], 2)
+        self.assertEqual(len(storage._contents), 8)
+        self.assertEqual(len(storage._directories), 6)
+        self.assertEqual(len(storage._revisions), 1)
+        origin_id = storage.origin_get({
+            'type': 'dir', 'url': 'file:///tmp/sample-folder'})['id']
+        visits = list(storage.origin_visit_get(origin_id))
+        self.assertEqual([visit['status'] for visit in visits],
+                         ['full', 'full'])
+        self.assertTrue(all(visit['snapshot'] for visit in visits))
+        rev_id = list(self.loader.objects['revision'])[0]
+        self.assertIsNotNone(next(storage.revision_get([rev_id])))
+
+    def test_replay_batch_bytes(self):
+        """Contents should be sent in batches limited in bytes"""
+        # given
+        self.load()
+        storage = Storage()
+        sent = []
+        content_add = storage.content_add
+
+        def record_content_add(content):
+            sent.append([c['length'] for c in content])
+            return content_add(content)
+
+        storage.content_add = record_content_add
+
+        # when
+        replay(storage, list_spools(self.spool_path), batch_bytes=100)
+
+        # then
+        self.assertEqual(len(storage._contents), 8)
+        self.assertGreater(len(sent), 1)
+        for lengths in sent:
+            self.assertTrue(sum(lengths) <= 100 or len(lengths) == 1,
+                            lengths)
+
+    def test_replay_interrupted(self):
+        """Incomplete records should be ignored"""
+        # given
+        self.load()
+        prefix = self.loader.storage.prefix
+        with open(prefix + '.idx', 'ab') as f:
+            f.write(b'\x02\x00')
+
+        # when
+        counters = replay(Storage(), [Spool(prefix)])
+
+        # then
+        self.assertEqual(counters['content'], 8)
+        self.assertEqual(os.path.getsize(prefix + '.idx') % INDEX_ENTRY.size,
+                         2)
@@ -0,0 +1,141 @@
+# Copyright (C) 2018  The Software Heritage developers
+# See the AUTHORS file at the top-level directory of this distribution
+# License: GNU General Public License version 3, or any later version
+# See top-level LICENSE file for more information
+
+import subprocess
+import sys
+import unittest
+
+from unittest.mock import patch
+
+from celery import current_app as app
+
+from swh.loader.dir.tests.test_loader import (BaseDirLoaderTest,
+                                              DirLoaderNoStorage,
+                                              SYNTHETIC_REVISION)
+from swh.storage.in_memory import Storage
+
+# Modules only needed to actually run a task
+HEAVY_MODULES = [
+    'swh.loader.core.loader',
+    'swh.model.from_disk',
+    'swh.storage',
+]
+
+# Budget for importing the tasks, relative to importing celery itself in the
+# same interpreter; importing the loader costs more than ten times as much
+IMPORT_TIME_RATIO = 4
+
+
+def import_times(module):
+    """Import module in a fresh interpreter with ``-X importtime``.
+
+    Returns:
+        dict: mapping from imported module names to their cumulative import
+        time in microseconds
+
+    """
+    # celery is needed to declare the tasks, do not account for it
+    code = 'from celery import current_app; import %s' % module
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', code],
+                          stderr=subprocess.PIPE, check=True)
+    times = {}
+    for line in proc.stderr.decode('utf-8').splitlines():
+        if not line.startswith('import time:'):
+            continue
+        _, cumulative, name = line.split('|')
+        try:
+            times[name.strip()] = int(cumulative)
+        except ValueError:  # header line
+            continue
+    return times
+
+
+class TestTasksStartup(unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+        self.times = import_times('swh.loader.dir.tasks')
+
+    def test_no_heavy_imports(self):
+        """Importing the tasks should not load the loader dependencies"""
+        for module in HEAVY_MODULES:
+            self.assertNotIn(module, self.times)
+
+    def test_import_time_budget(self):
+        """Importing the tasks should stay cheap compared to celery"""
+        budget = IMPORT_TIME_RATIO * self.times['celery']
+        self.assertLess(self.times['swh.loader.dir.tasks'], budget)
+
+
+class TestShardedLoading(BaseDirLoaderTest):
+    def setUp(self):
+        super().setUp()
+        app.conf.task_always_eager = True
+        self.addCleanup(setattr, app.conf, 'task_always_eager', False)
+
+        # all the tasks share the same storage
+        self.storage = Storage()
+        for target, value in [
+                ('swh.loader.dir.loader.DirLoader.parse_config_file',
+                 DirLoaderNoStorage.parse_config_file),
+                ('swh.loader.core.loader.get_storage',
+                 lambda **kwargs: self.storage)]:
+            patcher = patch(target, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_load_directory_sharded(self):
+        """Loading a tree in shards should give the same objects"""
+        from swh.loader.dir import tasks
+
+        # when
+        tasks.load_directory_sharded(
+            self.destination_path,
+            origin={'url': 'file:///tmp/sample-folder', 'type': 'dir'},
+            visit_date='Tue, 3 May 2016 17:16:32 +0200',
+            revision=SYNTHETIC_REVISION, release=None,
+            branch_name='master', shard_depth=2)
+
+        # then
+        self.assertCountContents(8)
+        self.assertCountDirectories(6)
+        self.assertCountRevisions(1)
+        self.assertCountSnapshots(1)
+
+        loader = DirLoaderNoStorage()
+        objects = loader.list_objs(
+            dir_path=self.destination_path.encode(),
+            revision=SYNTHETIC_REVISION, release=None,
+            branch_name='master')
+        self.assertRevisionsContain({
+            rev_id: full_rev['directory']
+            for rev_id, full_rev in objects['revision'].items()
+        })
+
+
+class TestScheduleLoadDirectory(BaseDirLoaderTest):
+    def schedule(self, **kwargs):
+        from swh.loader.dir import tasks
+
+        with patch.object(tasks.load_directory, 'apply_async') as apply_async:
+            tasks.schedule_load_directory(
+                self.destination_path,
+                origin={'url': 'file:///tmp/sample-folder', 'type': 'dir'},
+                visit_date='Tue, 3 May 2016 17:16:32 +0200',
+                revision=SYNTHETIC_REVISION, release=None, **kwargs)
+        return apply_async.call_args
+
+    def test_schedule_small(self):
+        args, kwargs = self.schedule()
+
+        self.assertNotIn('queue', kwargs)
+        self.assertEqual(kwargs['kwargs']['size_hint']['files'], 8)
+        self.assertFalse(kwargs['kwargs']['size_hint']['large'])
+
+    def test_schedule_large(self):
+        args, kwargs = self.schedule(thresholds={'files': 5})
+
+        self.assertEqual(kwargs['queue'],
+                         'swh.loader.dir.tasks.LoadDirRepository.large')
+        self.assertTrue(kwargs['kwargs']['size_hint']['large'])
@@ -0,0 +1,187 @@
+# Copyright (C) 2018  The Software Heritage developers
+# See the AUTHORS file at the top-level directory of this distribution
+# License: GNU General Public License version 3, or any later version
+# See top-level LICENSE file for more information
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import pytest
+
+from swh.loader.dir.readahead import ReadScheduler
+from swh.loader.dir.spool import Spool, replay
+from swh.loader.dir.tests.test_loader import (DirLoaderNoStorage,
+                                              SYNTHETIC_REVISION)
+from swh.loader.dir.walker import (DirectoryWalker, SkippedContent,
+                                   changed_since)
+from swh.model.from_disk import Directory
+from swh.storage.in_memory import Storage
+
+
+@pytest.mark.fs
+class TestDirectoryWalker(unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+        self.path = tempfile.mkdtemp(prefix='swh.loader.dir.',
+                                     suffix='-tests').encode()
+        os.makedirs(os.path.join(self.path, b'foo'))
+        with open(os.path.join(self.path, b'README'), 'wb') as f:
+            f.write(b'read me\n')
+        os.link(os.path.join(self.path, b'README'),
+                os.path.join(self.path, b'foo/README'))
+        os.link(os.path.join(self.path, b'README'),
+                os.path.join(self.path, b'foo/README.txt'))
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+        super().tearDown()
+
+    def test_walk_hardlinks(self):
+        """Hardlinked files should only be hashed once"""
+        expected = Directory.from_disk(path=self.path)
+
+        walker = DirectoryWalker(save_path=True)
+        directory = walker.walk(self.path)
+
+        self.assertEqual(directory.hash, expected.hash)
+        self.assertEqual(walker.counters['hashed'], 1)
+        self.assertEqual(walker.counters['linked'], 2)
+        self.assertEqual(walker.counters['linked_bytes'], 16)
+        self.assertIs(directory[b'foo/README'], directory[b'README'])
+        self.assertEqual(len(directory.collect()['content']), 1)
+
+    def test_walk_read_scheduler(self):
+        """Scheduling the reads should not change any id"""
+        expected = Directory.from_disk(path=self.path)
+
+        walker = DirectoryWalker(read_scheduler=ReadScheduler(readers=2))
+        directory = walker.walk(self.path)
+
+        self.assertEqual(walker.pending_reads, {})
+        self.assertEqual(directory.hash, expected.hash)
+        self.assertEqual(directory[b'README'].data,
+                         expected[b'README'].data)
+
+    def test_walk_skipped_contents(self):
+        """Large files should be skipped, special files never opened"""
+        os.mkfifo(os.path.join(self.path, b'fifo'))
+        with open(os.path.join(self.path, b'large'), 'wb') as f:
+            f.write(b'large\n' * 100)
+        expected = Directory.from_disk(path=self.path)
+
+        walker = DirectoryWalker(max_content_size=100)
+        directory = walker.walk(self.path)
+
+        self.assertEqual(directory.hash, expected.hash)
+        self.assertEqual(walker.counters['skipped'], 1)
+        self.assertEqual(directory[b'fifo'].data['length'], 0)
+        self.assertIsInstance(directory[b'large'], SkippedContent)
+        self.assertEqual(directory[b'large'].data, {
+            'sha1': expected[b'large'].data['sha1'],
+            'sha1_git': expected[b'large'].hash,
+            'sha256': expected[b'large'].data['sha256'],
+            'blake2s256': expected[b'large'].data['blake2s256'],
+            'length': 600,
+            'perms': expected[b'large'].data['perms'],
+            'status': 'absent',
+            'reason': 'Content too large',
+        })
+        objects = directory.collect()
+        self.assertEqual(list(objects['skipped_content']),
+                         [expected[b'large'].hash])
+        self.assertEqual(len(objects['content']), 2)
+
+    def add_large_files(self):
+        for name in [b'large', b'foo/larger']:
+            with open(os.path.join(self.path, name), 'wb') as f:
+                f.write(name * 100)
+
+    def load(self, loader):
+        return loader.load(
+            dir_path=self.path,
+            origin={'url': 'file:///tmp/walker-tests', 'type': 'dir'},
+            visit_date='Tue, 3 May 2016 17:16:32 +0200',
+            revision=SYNTHETIC_REVISION, release=None, branch_name='master')
+
+    def test_load_skipped_contents(self):
+        """Loading skipped contents should not fail the visit"""
+        self.add_large_files()
+        loader = DirLoaderNoStorage(content_size_limit=100)
+
+        self.assertEqual(self.load(loader), {'status': 'eventful'})
+        self.assertEqual(len(loader.objects['skipped_content']), 2)
+        self.assertEqual(
+            sorted(content['status']
+                   for content in loader.storage._contents.values()),
+            ['absent', 'absent', 'visible'])
+        origin_id = loader.storage.origin_get({
+            'type': 'dir', 'url': 'file:///tmp/walker-tests'})['id']
+        self.assertEqual(
+            [visit['status']
+             for visit in loader.storage.origin_visit_get(origin_id)],
+            ['full'])
+
+    def test_load_skipped_contents_again(self):
+        """Skipped contents already archived should not be sent again"""
+        self.add_large_files()
+        loader = DirLoaderNoStorage(content_size_limit=100)
+        self.load(loader)
+        storage = loader.storage
+        loader = DirLoaderNoStorage(content_size_limit=100)
+        loader.storage = storage
+        sent = []
+        content_add = storage.content_add
+
+        def record_content_add(contents):
+            sent.extend(contents)
+            return content_add(contents)
+
+        storage.content_add = record_content_add
+
+        self.load(loader)
+
+        self.assertEqual(sent, [])
+
+    def test_load_skipped_contents_spool(self):
+        """Skipped contents should be spooled, then replayed"""
+        self.add_large_files()
+        spool_path = tempfile.mkdtemp(prefix='swh.loader.dir.',
+                                      suffix='-spool')
+        self.addCleanup(shutil.rmtree, spool_path)
+        loader = DirLoaderNoStorage(content_size_limit=100,
+                                    spool=spool_path)
+        storage = Storage()
+
+        self.assertEqual(self.load(loader), {'status': 'eventful'})
+        counters = replay(storage, [Spool(loader.storage.prefix)])
+
+        self.assertEqual(counters['content'], 3)
+        self.assertEqual(
+            sorted(content['sha1_git']
+                   for content in storage._contents.values()
+                   if content['status'] == 'absent'),
+            sorted(loader.objects['skipped_content']))
+
+
+class TestChangedSince(unittest.TestCase):
+    def stat(self, mtime, ctime):
+        return os.stat_result((0o100644, 0, 0, 1, 0, 0, 0, 0, mtime, ctime))
+
+    def test_changed_since(self):
+        since = 1000.5
+        self.assertTrue(changed_since(self.stat(1001, 990), since))
+        self.assertTrue(changed_since(self.stat(990, 1001), since))
+        self.assertFalse(changed_since(self.stat(990, 990), since))
+
+    def test_changed_since_truncated_timestamps(self):
+        """Files changed right after the start of a listing, on file systems
+        truncating timestamps, should be racy
+
+        """
+        since = 1000.5
+        # changed at 1000.7, truncated to the second or to two seconds
+        self.assertTrue(changed_since(self.stat(1000, 1000), since))
+        self.assertTrue(changed_since(self.stat(998, 998), since))
+        self.assertFalse(changed_since(self.stat(997, 997), since))
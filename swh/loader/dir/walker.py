@@ -0,0 +1,517 @@
+# Copyright (C) 2018  The Software Heritage developers
+# See the AUTHORS file at the top-level directory of this distribution
+# License: GNU General Public License version 3, or any later version
+# See top-level LICENSE file for more information
+
+import collections
+import math
+import os
+import stat
+
+from swh.model.from_disk import Content, Directory, mode_to_perms
+from swh.model.hashutil import DEFAULT_ALGORITHMS
+
+from .readahead import hash_regular_file
+
+
+# Files changed this close to the start of a listing may have been changed
+# during it: file system timestamps may be truncated to the second (ext3,
+# NFS, HFS+), or even to two seconds (FAT)
+RACY_DELAY = 2
+
+
+def stat_key(file_stat):
+    """The stat fields telling whether a file changed.
+
+    """
+    return (file_stat.st_mode, file_stat.st_size, file_stat.st_mtime_ns)
+
+
+def changed_since(file_stat, since):
+    """Check whether the file of the given stat may have changed since the
+    `since` timestamp.
+
+    The change time is checked along with the modification time, which is
+    preserved by archive extraction, copies and syncs, and can be reset at
+    will. As in git, files changed in the same (truncated) second as
+    `since`, or within :data:`RACY_DELAY` before it, are racy: they are
+    considered changed.
+
+    """
+    return max(file_stat.st_mtime, file_stat.st_ctime) >= \
+        math.floor(since) - RACY_DELAY
+
+
+class ArchivedTree:
+    """A directory tree as previously archived, used to avoid hashing again
+    the entries which did not change since the previous visit.
+
+    The archived directories are listed lazily, as the walk reaches the
+    matching local directories.
+
+    Args:
+        storage: the storage holding the archived tree
+        root_id (bytes): identifier of the archived root directory
+        since (float): timestamp of the start of the previous listing;
+          files changed after it are always hashed again
+        previous_path (bytes): optional path of the previous version of
+          the tree, if still on disk; files whose stat differs from their
+          previous version are then hashed again
+
+    """
+    def __init__(self, storage, root_id, *, since, previous_path=None):
+        self.storage = storage
+        self.root_id = root_id
+        self.since = since
+        self.previous_path = previous_path
+        self.listings = {}
+
+    def listing(self, reldir):
+        """List the archived directory at `reldir`.
+
+        Returns:
+            dict: a mapping from entry names to directory entries, as
+            returned by :func:`swh.storage.storage.Storage.directory_ls`
+
+        """
+        if reldir in self.listings:
+            return self.listings[reldir]
+
+        if reldir == b'':
+            dir_id = self.root_id
+        else:
+            entry = self.entry(reldir)
+            dir_id = entry['target'] if entry and entry['type'] == 'dir' \
+                else None
+
+        listing = {}
+        if dir_id:
+            for entry in self.list_directory(dir_id):
+                listing[entry['name']] = entry
+
+        self.listings[reldir] = listing
+        return listing
+
+    def list_directory(self, dir_id):
+        """List the entries of the archived directory `dir_id`.
+
+        """
+        return self.storage.directory_ls(dir_id)
+
+    def entry(self, relpath):
+        """Get the archived entry at `relpath`, if any.
+
+        """
+        reldir, name = os.path.split(relpath)
+        return self.listing(reldir).get(name)
+
+    def unchanged_entry(self, relpath, file_stat):
+        """Get the archived file entry at `relpath`, if the file did not
+        change since the previous visit.
+
+        """
+        entry = self.entry(relpath)
+        if not entry or entry['type'] != 'file':
+            return None
+
+        if entry['perms'] != mode_to_perms(file_stat.st_mode) \
+           or entry['length'] != file_stat.st_size:
+            return None
+
+        if self.previous_path is not None:
+            # the file is unchanged if it matches its previous version,
+            # itself unchanged since the previous visit
+            try:
+                previous_stat = os.lstat(
+                    os.path.join(self.previous_path, relpath))
+            except OSError:
+                return None
+            if stat_key(previous_stat) != stat_key(file_stat):
+                return None
+            file_stat = previous_stat
+
+        if changed_since(file_stat, self.since):
+            return None
+
+        return entry
+
+    def content(self, relpath, file_stat):
+        """Build the content for the file at `relpath` out of the archived
+        listing, if the file did not change since the previous visit.
+
+        Args:
+            relpath (bytes): path of the file, relative to the root
+            file_stat (os.stat_result): the file's :func:`os.lstat`
+
+        Returns:
+            Content: the (already collected) content, or None if the
+            file needs to be hashed
+
+        """
+        entry = self.unchanged_entry(relpath, file_stat)
+        if not entry or not entry['sha1']:
+            return None
+
+        perms = mode_to_perms(file_stat.st_mode)
+        content = Content({
+            'sha1': entry['sha1'],
+            'sha1_git': entry['target'],
+            'sha256': entry['sha256'],
+            'length': entry['length'],
+            'perms': perms,
+        })
+        # already archived, nothing to send
+        content.collected = True
+        return content
+
+    def is_archived(self, relpath, directory):
+        """Check whether `directory`, found at `relpath`, matches the
+        archived subtree at the same path.
+
+        """
+        if relpath == b'':
+            archived_id = self.root_id
+        else:
+            entry = self.entry(relpath)
+            if not entry or entry['type'] != 'dir':
+                return False
+            archived_id = entry['target']
+
+        return directory.hash == archived_id
+
+
+class SkippedContent(Content):
+    """A content too large to be archived, collected apart from the other
+    contents.
+
+    Its data is not archived, only its hashes, which identify it in the
+    archive.
+
+    """
+    __slots__ = []
+    type = 'skipped_content'
+
+
+class KnownDirectory(Directory):
+    """A directory whose id is known, e.g. because it was loaded
+    separately, and whose entries are not walked.
+
+    """
+    def __init__(self, dir_id):
+        super().__init__()
+        self.dir_id = dir_id
+        # already loaded, nothing to send
+        self.collected = True
+
+    def compute_hash(self):
+        return self.dir_id
+
+
+class DirectoryWalker:
+    """Compute the Software Heritage objects for an on-disk directory tree.
+
+    This mirrors :func:`swh.model.from_disk.Directory.from_disk`, but lets
+    the loader reuse hashes it already knows instead of reading the files
+    again.
+
+    Contents whose `sha1_git` is known beforehand (e.g. from a git index),
+    or all contents when hashes are deferred, are only partially hashed by
+    the walk: :func:`complete_contents` must then be called before
+    collecting the objects.
+
+    Files hardlinked within the tree are only hashed once: all their paths
+    share the same content object.
+
+    Files larger than `max_content_size` become :class:`SkippedContent`
+    objects. Special files (FIFOs, sockets, devices) are never opened.
+
+    Args:
+        save_path (bool): whether to add the path to the content objects
+        archived (ArchivedTree): optional listing of the previously
+          archived version of the tree
+        git_index (GitIndex): optional index of the git work tree at the
+          root of the tree
+        known_directories (dict): a mapping from relative paths of
+          subdirectories to their already loaded ids, which are not walked
+        deferred_hashes (bool): whether to only compute the `sha1_git` of
+          the files during the walk, the other hashes being computed for
+          the contents missing from the archive only
+        read_scheduler (ReadScheduler): optional scheduler of the reads of
+          the files to hash, which are then all read at the end of the walk
+          (or of :func:`complete_contents`) instead of in the walk order
+        max_content_size (int): size above which contents are skipped
+
+    """
+    def __init__(self, *, save_path=False, archived=None, git_index=None,
+                 known_directories=None, deferred_hashes=False,
+                 read_scheduler=None, max_content_size=None):
+        self.save_path = save_path
+        self.archived = archived
+        self.git_index = git_index
+        self.known_directories = known_directories or {}
+        self.deferred_hashes = deferred_hashes
+        self.read_scheduler = read_scheduler
+        self.max_content_size = max_content_size
+        self.partial_contents = []
+        # reads postponed until read_files, by set of hashes to compute
+        self.pending_reads = collections.defaultdict(list)
+        # contents of the files with several links, by (st_dev, st_ino)
+        self.inodes = {}
+        self.counters = {
+            'hashed': 0,
+            'reused': 0,
+            'git': 0,
+            'deferred': 0,
+            'linked': 0,
+            'linked_bytes': 0,
+            'skipped': 0,
+        }
+
+    def content_from_file(self, path, relpath):
+        """Compute the content for the file at `path`.
+
+        """
+        file_stat = os.lstat(path)
+        inode = None
+        if stat.S_ISREG(file_stat.st_mode) and file_stat.st_nlink > 1:
+            inode = (file_stat.st_dev, file_stat.st_ino)
+            content = self.inodes.get(inode)
+            if content is not None:
+                self.counters['linked'] += 1
+                self.counters['linked_bytes'] += file_stat.st_size
+                return content
+
+        content = self._content_from_file(path, relpath, file_stat)
+        if inode:
+            self.inodes[inode] = content
+        return content
+
+    def _content_from_file(self, path, relpath, file_stat):
+        if self.archived:
+            content = self.archived.content(relpath, file_stat)
+            if content is not None:
+                self.counters['reused'] += 1
+                return content
+
+        if stat.S_ISREG(file_stat.st_mode) \
+           and self.max_content_size is not None \
+           and file_stat.st_size > self.max_content_size:
+            return self.skipped_content(path, relpath, file_stat)
+
+        if self.git_index:
+            sha1_git = self.git_index.sha1_git(relpath, file_stat)
+            if sha1_git:
+                self.counters['git'] += 1
+                return self.partial_content(path, file_stat, sha1_git)
+
+        if not stat.S_ISREG(file_stat.st_mode):
+            # symbolic links and special files are cheap to hash in full,
+            # but still need to be looked up when hashes are deferred
+            if stat.S_ISLNK(file_stat.st_mode):
+                content = Content.from_symlink(path=path,
+                                               mode=file_stat.st_mode)
+            else:
+                # never open FIFOs, sockets and devices: they are archived
+                # as empty files
+                content = Content.from_bytes(mode=file_stat.st_mode,
+                                             data=b'')
+            if self.deferred_hashes:
+                self.counters['deferred'] += 1
+                self.partial_contents.append((content, path))
+            else:
+                self.counters['hashed'] += 1
+            return content
+
+        content = self.file_content(path, file_stat)
+        if self.deferred_hashes:
+            self.counters['deferred'] += 1
+            self.partial_contents.append((content, path))
+            self.hash_file(content, path, file_stat, {'sha1_git'})
+        else:
+            self.counters['hashed'] += 1
+            self.hash_file(content, path, file_stat)
+        return content
+
+    def file_content(self, path, file_stat, **data):
+        """Build a content for the file at `path` out of its stat, and of
+        the hashes given in `data`, without reading the file.
+
+        """
+        data.update({
+            'length': file_stat.st_size,
+            'perms': mode_to_perms(file_stat.st_mode),
+        })
+        if self.save_path:
+            data['path'] = path
+        return Content(data)
+
+    def skipped_content(self, path, relpath, file_stat):
+        """Build a skipped content for the file at `path`, too large to be
+        archived.
+
+        Its hashes are taken from the previous visit if possible. Its
+        `sha1_git`, which the directory ids depend on, may also come from
+        the git index, its other hashes then being computed if it is missing
+        from the archive (see :func:`complete_contents`). Otherwise, the
+        file is read once to compute all its hashes.
+
+        """
+        self.counters['skipped'] += 1
+        content = SkippedContent({
+            'length': file_stat.st_size,
+            'perms': mode_to_perms(file_stat.st_mode),
+            'status': 'absent',
+            'reason': 'Content too large',
+        })
+
+        entry = None
+        if self.archived:
+            entry = self.archived.unchanged_entry(relpath, file_stat)
+        if entry:
+            content.data['sha1_git'] = entry['target']
+            for hash_name in DEFAULT_ALGORITHMS - {'sha1_git'}:
+                if entry.get(hash_name):
+                    content.data[hash_name] = entry[hash_name]
+            # already archived, nothing to send
+            content.collected = True
+            return content
+
+        if self.git_index:
+            sha1_git = self.git_index.sha1_git(relpath, file_stat)
+            if sha1_git:
+                content.data['sha1_git'] = sha1_git
+                self.partial_contents.append((content, path))
+                return content
+
+        self.hash_file(content, path, file_stat)
+        return content
+
+    def partial_content(self, path, file_stat, sha1_git):
+        """Build a content for the file at `path` out of its known
+        `sha1_git`, without reading the file.
+
+        """
+        content = self.file_content(path, file_stat, sha1_git=sha1_git)
+        self.partial_contents.append((content, path))
+        return content
+
+    def hash_file(self, content, path, file_stat,
+                  hash_names=DEFAULT_ALGORITHMS):
+        """Add the hashes of the regular file at `path` to `content`, now
+        or, if reads are scheduled, in :func:`read_files`.
+
+        """
+        if self.read_scheduler:
+            self.pending_reads[frozenset(hash_names)].append(
+                (content, path, file_stat))
+            return
+
+        content.data.update(hash_regular_file(path, hash_names=hash_names))
+
+    def read_files(self):
+        """Hash the files whose reads were postponed by the scheduler.
+
+        """
+        pending_reads = self.pending_reads
+        self.pending_reads = collections.defaultdict(list)
+
+        for hash_names, reads in pending_reads.items():
+            hashes = self.read_scheduler.hash_files(
+                [(path, file_stat) for _, path, file_stat in reads],
+                hash_names=hash_names)
+            for (content, _, _), digest in zip(reads, hashes):
+                content.data.update(digest)
+
+    def complete_contents(self, storage, batch_size=1000):
+        """Complete the partially hashed contents found by the walk.
+
+        The contents already in `storage` are not collected, the other ones
+        are read and fully hashed if needed.
+
+        Args:
+            storage: the storage to look the contents up in
+            batch_size (int): number of contents looked up at once
+
+        """
+        partial_contents = self.partial_contents
+        self.partial_contents = []
+
+        for start in range(0, len(partial_contents), batch_size):
+            batch = partial_contents[start:start+batch_size]
+            found = storage.object_find_by_sha1_git(
+                [content.data['sha1_git'] for content, _ in batch])
+
+            for content, path in batch:
+                objects = found.get(content.data['sha1_git'], [])
+                if any(obj['type'] == 'content' for obj in objects):
+                    # already archived, nothing to send
+                    content.collected = True
+                    continue
+
+                if 'sha1' in content.data:
+                    continue
+
+                self.counters['hashed'] += 1
+                file_stat = os.lstat(path)
+                if stat.S_ISREG(file_stat.st_mode):
+                    self.hash_file(content, path, file_stat,
+                                   DEFAULT_ALGORITHMS - {'sha1_git'})
+                else:
+                    content.data.update(Content.from_file(
+                        path=path, save_path=self.save_path).data)
+
+        self.read_files()
+
+    def walk(self, path):
+        """Walk the tree rooted at `path`.
+
+        Args:
+            path (bytes): the directory to traverse
+
+        Returns:
+            Directory: the root directory of the tree
+
+        """
+        top_path = path
+        dirs = {}
+
+        # Walk top-down to prune the known subtrees, then build the
+        # directories bottom-up
+        walked = []
+        for root, dentries, fentries in os.walk(top_path):
+            relroot = os.path.relpath(root, top_path)
+            if relroot == b'.':
+                relroot = b''
+
+            walked.append((root, relroot, dentries + fentries))
+            for name in list(dentries):
+                relpath = os.path.join(relroot, name)
+                if relpath in self.known_directories:
+                    dentries.remove(name)
+                    dirs[os.path.join(root, name)] = KnownDirectory(
+                        self.known_directories[relpath])
+
+        for root, relroot, names in reversed(walked):
+            entries = {}
+            # Join fentries and dentries in the same processing, as symbolic
+            # links to directories appear in dentries...
+            for name in names:
+                path = os.path.join(root, name)
+                if not os.path.isdir(path) or os.path.islink(path):
+                    entries[name] = self.content_from_file(
+                        path, os.path.join(relroot, name))
+                else:
+                    entries[name] = dirs[path]
+
+            directory = Directory({'name': os.path.basename(root)})
+            directory.update(entries)
+            dirs[root] = directory
+
+        # the directory ids are only known once all the files are read
+        self.read_files()
+        if self.archived:
+            for root, relroot, _ in walked:
+                if self.archived.is_archived(relroot, dirs[root]):
+                    dirs[root].collected = True
+
+        return dirs[top_path]